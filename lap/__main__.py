@@ -20,11 +20,8 @@ Note:
 --snip--
 
 TODO:
- - Don't pass nonexistant paths to Audacious. It actually adds them to the
-   playlist.
  - Still needs more refactoring.
  - Decide how to expose filtering options from locate.
- - Implement /-triggered "search within these results" for lap.
  - Look into "insert before/after current song" as an MPRIS option
  - Complete the list of extensions for ModPlug and UADE (3rd-party)
  - Support an "all" keyword and an alternative to Ctrl+C for cancel. (maybe 0)
@@ -38,94 +35,296 @@ __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2 or later"
 from .version import __version__
 
-from .filetypes import OK_EXTS, BLACKLISTED_EXTS
+from .filetypes import (OK_EXTS, BLACKLISTED_EXTS, FILETYPES, compile_exts,
+                        has_ext, parse_type_args)
 
 DEFAULT_RAND_COUNT = 10
 
 locate_command = ['locate', '-i']
 
-# ========== Configuration Ends ==========
-
-import string  # pylint: disable=deprecated-module
-import fnmatch, logging, os, random, shlex, subprocess, sys
-log = logging.getLogger(__name__)
+# Databases to read directly (if permissions allow) rather than calling
+# locate_command. The first readable mlocate database wins.
+locate_dbs = ['/var/lib/mlocate/mlocate.db']
 
-from .ui.fallback_chooser import choose
-try:
-    from .ui.urwid_chooser import UrwidChooser
-except ImportError:
-    UrwidChooser = None  # pylint: disable=invalid-name
+# MPRIS players to prefer (eg. 'audacious'), in order, if several are running
+preferred_players = []
 
-try:
-    from .output.mpris import MPRISAdder, DBusException
-except ImportError:
-    DBusException = None  # pylint: disable=invalid-name
+# ========== Configuration Ends ==========
 
-def sh_quote(text):
-    """Reliably quote a string as a single argument for /bin/sh
+import logging, os, sys
+log = logging.getLogger(__name__)
 
-    Borrowed from the pipes module in Python 2.6.2 stdlib and fixed to quote
-    empty strings properly and pass completely safechars strings through.
+# NOTE: Everything not needed by every code path (the choosers, the MPRIS
+#       backend, the search backends, etc.) is imported where it's used to
+#       keep startup fast for shell keybindings. See tools/check_startup.py
+
+def gather_random(roots, wanted_count, jobs=1, seed=None, exts=None,
+                  sniffer=None, snapshots=None, weights=(), per_album=False,
+                  max_per_album=None, no_repeat=False,
+                  blacklist=BLACKLISTED_EXTS, pools=None):
+    """Choose C{wanted_count} files from C{roots} in a single streaming pass.
+
+    That holds only C{wanted_count} paths in memory, but C{weights},
+    C{per_album}, C{max_per_album} and C{no_repeat} need a L{WeightedPool}
+    of every file, which is O(n) to build. Pass C{pools} with C{snapshots}
+    to keep those between calls.
+
+    @param jobs: The number of threads to walk C{roots} with.
+    @param seed: If not C{None}, make the selection reproducible for a given
+        set of files, regardless of C{jobs}.
+    @param exts: If not C{None}, only consider files with these extensions
+        rather than everything not in C{blacklist}.
+    @param blacklist: The extensions to skip when C{exts} is C{None}.
+    @param sniffer: If provided, a L{SniffFilter} used to verify files which
+        can't be judged by their extension alone.
+    @param snapshots: If provided, L{LibrarySnapshot}s to read the files
+        under C{roots} from rather than walking them.
+    @param weights: C{(kind, key, weight)} tuples from L{parse_weight_args}
+        to bias the selection. See L{get_weights}.
+    @param per_album: Give every directory the same total weight rather
+        than every file.
+    @param max_per_album: If provided, choose at most this many files from
+        any one directory.
+    @param no_repeat: Don't choose files chosen by earlier calls with the
+        same C{roots} until all of them have been. See L{ShuffleHistory}.
+    @param pools: A C{dict} in which to cache L{WeightedPool}s for
+        C{snapshots}, each rebuilt only when a snapshot changes.
+    @type roots: C{list} of C{basestring}
     """
-    _safechars = string.ascii_letters + string.digits + '!@%_-+=:,./'
-    _funnychars = '"`$\\'           # Unsafe inside "double quotes"
-
-    if not text:
-        return "''"
+    def keep(name):
+        """Filter out files with unwanted extensions"""
+        if sniffer and sniffer.needs_sniff(name):
+            return True
+        elif exts is None:
+            return not has_ext(name, blacklist)
+        return has_ext(name, exts)
+
+    def iter_paths():
+        """Yield every file under C{roots} which passes C{keep}"""
+        from .walk import iter_files, iter_files_parallel
+        if snapshots is not None:
+            paths = (path for snapshot in snapshots
+                     for path in snapshot.iter_files(keep))
+        elif jobs > 1:
+            paths = iter_files_parallel(roots, keep, jobs)
+        else:
+            paths = (path for root in roots
+                     for path in iter_files(root, keep))
+        return sniffer.filter(paths) if sniffer else paths
+
+    from .sampling import keyed_sample, reservoir_sample
+
+    if weights or per_album or max_per_album or no_repeat:
+        import random
+        from .sampling import WeightedPool, get_weights, weighted_sample
+        rng = random if seed is None else random.Random(str(seed))
+
+        config = stamp = pool = None
+        if pools is not None and snapshots is not None:
+            config = (exts, blacklist, bool(sniffer), tuple(weights),
+                      per_album)
+            stamp = tuple((id(x), x.generation) for x in snapshots)
+            stamped = pools.get(config)
+            if stamped and stamped[0] == stamp:
+                pool = stamped[1]
+
+        if pool is None:
+            # Sorted to make seeded results independent of walk order
+            paths = sorted(iter_paths())
+            pool = WeightedPool(paths, get_weights(paths, weights, per_album))
+            if config is not None:
+                pools[config] = (stamp, pool)
+
+        args = (pool, wanted_count)
+        kwargs = dict(rng=rng, group_of=os.path.dirname,
+                      max_per_group=max_per_album)
+        if not no_repeat:
+            return weighted_sample(*args, **kwargs)
+
+        from .history import ShuffleHistory, get_history_path, sample_unplayed
+        with ShuffleHistory(get_history_path(roots)) as history:
+            return sample_unplayed(history, *args, **kwargs)
+
+    paths = iter_paths()
+    if seed is None:
+        return reservoir_sample(paths, wanted_count)
+    return keyed_sample(paths, wanted_count, seed)
 
-    for char in text:
-        if char not in _safechars:
-            break
+# TODO: Refactor and reuse elsewhere
+def get_results(query, locate_cmd=locate_command,  # pylint: disable=W0102
+                index=None, db_paths=locate_dbs, exts=OK_EXTS,
+                sniffer=None, keywords=None, limit=None, page=1,
+                cache=None):
+    """Retrieve matches for C{query} in C{exts} using L{locate_command}.
+
+    If one of C{db_paths} is a readable mlocate database, it will be searched
+    directly instead of running C{locate_cmd}.
+
+    @param index: If provided, a L{MediaIndex} to query instead of running
+        C{locate}.
+    @param sniffer: If provided, a L{SniffFilter} used to verify ambiguous
+        results and to find media among files with no extension.
+    @param keywords: Additional keywords which must also match.
+    @param limit: If provided, return only the given C{page} of the C{limit}
+        most relevant results, best first, rather than every result in
+        alphabetical order.
+    @param cache: If provided, a L{QueryCache} to reuse the results for
+        C{query} from, if still valid, or store them in.
+    """
+    if cache is None:
+        results = iter_results(query, locate_cmd, index, db_paths, exts,
+                               sniffer)
+        results = refine_results(results, sniffer=sniffer)
     else:
-        return text
-
-    if not [x for x in text if x not in _safechars]:
-        return text
-    elif '\'' not in text:
-        return '\'' + text + '\''
-
-    res = ''
-    for char in text:
-        if char in _funnychars:
-            char = '\\' + char
-        res = res + char
-    return '"' + res + '"'
+        results = _get_cached(cache, query, locate_cmd, index, db_paths,
+                              exts, sniffer)
 
+    if isinstance(query, basestring):
+        query = [query]
+    return _order_results(refine_results(results, keywords),
+                          query + (keywords or []), limit, page)
 
-def gather_random(roots, wanted_count):
-    """Use C{os.walk} to choose C{wanted_count} files from C{roots}.
+def get_tag_results(terms, keywords=None, exts=OK_EXTS, limit=None, page=1,
+                    sniffer=None):
+    """Like L{get_results}, but for C{field:value} terms, which are answered
+    from the L{TagIndex} and then narrowed down by any path C{keywords}.
 
-    @type roots: C{list} of C{basestring}
+    @param terms: C{(field, value)} tuples from L{split_query}.
+    @param sniffer: If provided, a L{SniffFilter} used to verify ambiguous
+        results by their content.
     """
-    choices = []
-    for root in roots:
-        for fldr, _, files in os.walk(root):
-            # pylint: disable=bad-continuation
-            choices.extend(os.path.join(fldr, x) for x in files
-                    if not os.path.splitext(x)[1].lower() in BLACKLISTED_EXTS)
+    from .tags import TagIndex
+    index = TagIndex()
+    try:
+        if index.is_empty():
+            log.warning("No tags have been indexed. Use --update-index "
+                        "with mutagen installed to index them.")
+        results = [x for x in index.search(terms) if has_ext(x, exts)]
+    finally:
+        index.close()
+
+    keywords = keywords or []
+    return _order_results(refine_results(results, keywords, sniffer),
+                          keywords, limit, page)
+
+def _order_results(results, keywords, limit=None, page=1):
+    """Sort C{results} or, if C{limit} is set, return the requested page
+    of the most relevant ones for C{keywords}."""
+    if not limit:
+        return sorted(results)
+
+    from .query import rank_results
+    results, total = rank_results(results, keywords, limit, page)
+    if total > page * limit:
+        log.warning("Showing %d of %d matches. Use --page %d for more.",
+                    len(results), total, page + 1)
+    return results
+
+def _get_cached(cache, query, locate_cmd, index, db_paths, exts, sniffer):
+    """Return the (unsorted) results for C{query} from C{cache}, searching
+    and storing them first if the backend's database has changed."""
+    from .querycache import LOCATE_DB_PATHS, get_stamp
+    if isinstance(query, basestring):
+        query = [query]
 
-    chosen = []
-    for _ in range(0, wanted_count):
-        if choices:
-            # We don't want duplicates
-            chosen.append(choices.pop(random.randrange(0, len(choices))))
+    if index is not None:
+        backend = ('index', index.db_path)
+        stamp = get_stamp([index.db_path])
+    else:
+        backend = ('locate',) + tuple(locate_cmd) + tuple(db_paths)
+        stamp = get_stamp(list(db_paths) + LOCATE_DB_PATHS)
+
+    key = (tuple(query), backend, tuple(sorted(exts)), bool(sniffer))
+    # Without a database to check against, nothing could invalidate it
+    results = cache.get(key, stamp) if stamp else None
+    if results is None:
+        results = iter_results(query, locate_cmd, index, db_paths, exts,
+                               sniffer)
+        results = list(refine_results(results, sniffer=sniffer))
+        if stamp:
+            cache.put(key, stamp, results)
+    else:
+        log.debug("Using cached results for %r", query)
+    return results
 
-    return chosen
+def iter_results(query, locate_cmd=locate_command,  # pylint: disable=W0102
+                 index=None, db_paths=locate_dbs, exts=OK_EXTS,
+                 sniffer=None):
+    """Return an iterable of unsorted, unverified results for
+    L{get_results} from the first usable backend.
 
-# TODO: Refactor and reuse elsewhere
-def get_results(query, locate_cmd=locate_command):  # pylint: disable=W0102
-    """Retrieve matches for C{query} in L{OK_EXTS} using L{locate_command}."""
+    If the search is done by a C{locate} subprocess, the iterable has a
+    C{cancel()} method which may be called from another thread.
+    """
     if isinstance(query, basestring):
         query = [query]
 
-    results, cmd = [], locate_cmd + query
-    for line in subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout:
-        result = line.strip()
-        if os.path.splitext(result)[1] in OK_EXTS:
-            results.append(result)
-    results.sort()
-    return results
+    if index is not None:
+        results = set()
+        for term in query:
+            results.update(x for x in index.search(term) if has_ext(x, exts))
+        return results
+
+    from .locatedb import MLocateDB, UnsupportedDatabase
+    for db_path in db_paths:
+        try:
+            database = MLocateDB(db_path)
+        except (EnvironmentError, UnsupportedDatabase), err:
+            log.debug("Falling back from %s: %s", db_path, err)
+            continue
+        return _search_db(database, query, exts, misnamed=bool(sniffer))
+
+    def keep(result):
+        """Filter out files with unwanted extensions"""
+        return has_ext(result, exts) or (
+            sniffer and sniffer.needs_sniff(os.path.basename(result)))
+
+    from .stream import LocateProcess
+    return LocateProcess(locate_cmd + query, keep)
+
+def _search_db(database, query, exts, misnamed):
+    """Yield results from an L{MLocateDB}, closing it when done."""
+    try:
+        for result in database.search(query, exts, misnamed):
+            yield result
+    finally:
+        database.close()
+
+def refine_results(paths, keywords=None, sniffer=None):
+    """Apply content verification and the remaining keywords of an implicit
+    AND query to a stream of results from L{iter_results}."""
+    if sniffer:
+        paths = sniffer.filter(paths)
+    if keywords:
+        from .query import compile_keywords
+        matches = compile_keywords(keywords)
+        paths = (x for x in paths if matches(x))
+    return paths
+
+
+def get_urwid_chooser():
+    """Import and return L{UrwidChooser} or C{None} if urwid is missing."""
+    try:
+        from .ui.urwid_chooser import UrwidChooser
+    except ImportError:
+        return None
+    return UrwidChooser
+
+def get_mpris_adder(preferred=None):
+    """Import the MPRIS backend and return an C{add_tracks} function.
+
+    @raises EnvironmentError: dbus-python is missing or no suitable player
+        could be reached.
+    """
+    try:
+        from .output.mpris import MPRISAdder, DBusException
+    except ImportError, err:
+        raise EnvironmentError(err)
 
+    try:
+        return MPRISAdder(preferred=preferred).add_tracks
+    except DBusException, err:
+        raise EnvironmentError(err)
 
 # TODO: Split this up more
 def main():
@@ -144,17 +343,45 @@ def main():
     opars.add_option("-0", "--print0", action="store_true", dest="print_null",
             default=False, help="Display the list of results, separated by "
                                 "NULL characters. (good for `xargs -0`)")
+    opars.add_option("--daemon", action="store_true", dest="run_daemon",
+        default=False, help="Stay resident and answer requests from other "
+        "lap invocations so they start faster. (Stop with Ctrl+C)")
     opars.add_option("-e", "--exec", action="store", dest="exe_cmd",
         default='', help="Use this command to enqueue/play rather than "
                          "the default.")
+    opars.add_option("--index", action="store_true", dest="use_index",
+            default=False, help="Answer --locate queries from lap's own "
+                                "media index rather than `locate`.")
+    opars.add_option("-j", "--jobs", action="store", type=int, dest="jobs",
+        default=1, metavar="NUM", help="Use NUM threads to walk directories "
+                                       "for --random. (default: %default)")
+    opars.add_option("--limit", action="store", type=int, dest="limit",
+        default=None, metavar="NUM", help="Only show the NUM most relevant "
+        "--locate results, best first, rather than all of them in "
+        "alphabetical order. (ignored with --stream)")
     opars.add_option("-l", "--locate", action="store_true", dest="locate",
             default=(cmd.lower() in ('lap', 'laq')),
             help="Treat the arguments as search keywords rather than "
                  "paths. (default if called as 'lap' or 'laq')")
+    opars.add_option("--max-per-album", action="store", type=int,
+        dest="max_per_album", default=None, metavar="NUM", help="Choose at "
+        "most NUM --random files from any one directory.")
+    opars.add_option("--max-procs", action="store", type=int,
+        dest="max_procs", default=1, metavar="NUM", help="Allow --exec to "
+        "run NUM batches of paths at once. (default: %default, which "
+        "preserves order)")
     opars.add_option("-n", "--song-count", action="store", type=int,
         dest="wanted_count", default=DEFAULT_RAND_COUNT, metavar="NUM",
         help="Request that NUM randomly-chosen songs be picked rather than"
              " %default.")
+    opars.add_option("--no-cache", action="store_false", dest="use_cache",
+        default=True, help="Don't reuse or store cached --locate results.")
+    opars.add_option("--no-daemon", action="store_false", dest="use_daemon",
+        default=True, help="Do all the work in this process even if a "
+                           "--daemon is running.")
+    opars.add_option("--no-repeat", action="store_true", dest="no_repeat",
+        default=False, help="Don't pick --random files which earlier runs "
+        "with the same paths picked until all of them have been.")
     opars.add_option("--no-urwid", action="store_false", dest="urwid",
         default=True, help="Don't use urwid-based ncurses chooser even if it "
                            "is available.")
@@ -165,6 +392,15 @@ def main():
             help="Show the full path to each result.")
     opars.add_option('-q', '--quiet', action="count", dest="quiet",
         default=0, help="Decreased verbosity. Use twice for extra effect")
+    opars.add_option("--page", action="store", type=int, dest="page",
+        default=1, metavar="NUM", help="Show page NUM of the results "
+                                       "selected by --limit.")
+    opars.add_option("--per-album", action="store_true", dest="per_album",
+        default=False, help="Give every directory an equal chance in "
+        "--random selections rather than every file.")
+    opars.add_option("--player", action="append", dest="players",
+        default=[], metavar="NAME", help="Prefer the MPRIS player NAME (eg. "
+        "audacious) if several are running. May be given more than once.")
     opars.add_option("-Q", "--enqueue", action="store_true", dest="enqueue",
             default=(cmd.lower() in ('aq', 'laq', 'raq')),
             help="Don't start the song playing after enqueueing it. "
@@ -173,9 +409,39 @@ def main():
             default=(cmd.lower() in ('rap', 'raq')),
             help="Select X entries at random from the provided paths. "
                  "(default if called as 'rap' or 'raq')")
+    opars.add_option("--seed", action="store", dest="seed", default=None,
+        help="Make --random selections reproducible for a given seed and set "
+             "of files.")
     opars.add_option("--sh", action="store_true", dest="print_quoted",
             help="Like --print but shell-quoted for use with tab completion "
                  "via backticks")
+    opars.add_option("--snapshot", action="store_true", dest="snapshot",
+        default=False, help="Pick --random files from a saved listing of "
+        "each directory, only re-reading the subdirectories which changed. "
+        "A --daemon keeps the listings current as files change.")
+    opars.add_option("--sniff", action="store_true", dest="sniff",
+        default=False, help="Identify files with missing or ambiguous "
+                            "extensions by their contents.")
+    opars.add_option("--stream", action="store_true", dest="stream",
+        default=False, help="Show the chooser right away and add --locate "
+        "results to it as they're found. With --print or --print0, print "
+        "them as they're found.")
+    opars.add_option("-t", "--type", action="append", dest="types",
+        default=[], metavar="TYPE",
+        help="Only consider files of the given TYPE, or exclude it if "
+             "given as noTYPE. May be given more than once. See "
+             "--help-types for a list.")
+    opars.add_option("--help-types", action="store_true", dest="help_types",
+        default=False, help="List the values accepted by --type and exit.")
+    opars.add_option("--update-index", action="store_true",
+            dest="update_index", default=False,
+            help="Add the given paths to lap's media index (or rescan them "
+                 "if already present), then exit. If mutagen is installed, "
+                 "also index their tags for field:value searches.")
+    opars.add_option("--weight", action="append", dest="weight_args",
+        default=[], metavar="DIR=W", help="Make --random selections W times "
+        "as likely to come from DIR (or, given as type:TYPE=W, from that "
+        "--type). May be given more than once.")
     opars.add_option('-v', '--verbose', action="count", dest="verbose",
         default=2, help="Increased verbosity. Use twice for extra effect")
 
@@ -192,7 +458,49 @@ def main():
     logging.basicConfig(level=log_levels[opts.verbose],
                         format='%(levelname)s: %(message)s')
 
+    if opts.help_types:
+        for name in sorted(FILETYPES):
+            print("%-10s %s" % (name, ' '.join(FILETYPES[name])))
+        return
+
+    exts, blacklist = None, BLACKLISTED_EXTS
+    if opts.types:
+        try:
+            include, exclude = parse_type_args(opts.types)
+        except KeyError, err:
+            opars.error("Unknown filetype: %s (see --help-types)" %
+                        err.args[0])
+
+        if opts.random and include is None:
+            # Only exclusions, so add them to --random's usual blacklist
+            # rather than switching to the DEFAULT_TYPES whitelist.
+            blacklist = blacklist.union(compile_exts(exclude))
+        else:
+            exts = compile_exts(include, exclude)
+
+    weights = []
+    if opts.weight_args:
+        from .sampling import parse_weight_args
+        try:
+            weights = parse_weight_args(opts.weight_args)
+        except KeyError, err:
+            opars.error("Unknown filetype: %s (see --help-types)" %
+                        err.args[0])
+        except ValueError, err:
+            opars.error("Bad --weight: %s" % err)
+    if opts.max_per_album is not None and opts.max_per_album < 1:
+        opars.error("--max-per-album must be at least 1")
+
+    if opts.run_daemon:
+        from .daemon import LapDaemon
+        try:
+            LapDaemon().serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
     if not args:
+        import subprocess
         try:
             # TODO: Do I really want this case to require Python 2.7?
             args.append(subprocess.check_output(
@@ -205,43 +513,167 @@ def main():
             else:
                 raise
 
+    sniffer = None
+    if opts.sniff:
+        from .sniff import SniffFilter
+        use_blacklist = opts.random and exts is None
+        sniffer = SniffFilter(exts, jobs=max(opts.jobs, 4),
+                              sniff_unknown=use_blacklist,
+                              blacklist=use_blacklist and blacklist or None)
+
+    if opts.update_index:
+        from .index import MediaIndex
+        MediaIndex().update(args)
+
+        from .tags import TagIndex, mutagen
+        if mutagen is None:
+            log.info("mutagen is not installed. Not indexing tags.")
+        else:
+            TagIndex().update(args, jobs=opts.jobs if opts.jobs > 1 else None)
+        return
+
+    if opts.limit is not None and opts.limit < 1 or opts.page < 1:
+        opars.error("--limit and --page must be at least 1")
+
+    # Hand the heavy lifting to a running --daemon if there is one
+    client = None
+    if opts.use_daemon:
+        from .daemon import connect
+        client = connect()
+
+    use_chooser = opts.locate and not (opts.random or opts.print_nl or
+                                       opts.print_null)
+    chooser_cls = use_chooser and opts.urwid and get_urwid_chooser()
+
     # If opts.locate, resolve args using `locate` first.
+    stream = None
     if opts.locate:
+        # An empty --type selection matches nothing rather than the defaults
+        search_exts = OK_EXTS if exts is None else exts
+        index = None
+        if opts.use_index:
+            from .index import MediaIndex
+            index = MediaIndex()
+
+        # field:value terms (eg. artist:beatles) are answered from tags
+        terms = []
+        if any(':' in x for x in args):
+            from .tags import split_query
+            terms, args = split_query(args)
+
         # Implement implicit AND for locate (default is implicit OR)
-        results = (len(args) > 0) and get_results(args.pop(0)) or []
-        for keyword in args:
-            results = [x for x in results
-                    # TODO: Implement locate's "only *%s* if no globbing chars"
-                    if fnmatch.fnmatch(x.lower(), '*%s*' % keyword.lower())]
+        if terms:
+            results = get_tag_results(terms, args, search_exts,
+                                      opts.limit, opts.page, sniffer)
+        elif opts.stream and not (use_chooser or opts.random):
+            # Nothing needs the full list, so print results as they arrive
+            results = refine_results(iter_results(args[0], index=index,
+                                                  exts=search_exts,
+                                                  sniffer=sniffer),
+                                     args[1:], sniffer)
+        elif opts.stream and chooser_cls:
+            from .stream import ResultStream
+            keywords = args[1:]
+            stream = ResultStream(iter_results(args[0], index=index,
+                                               exts=search_exts,
+                                               sniffer=sniffer),
+                lambda paths: refine_results(paths, keywords, sniffer))
+            results = []
+        else:
+            results = client and client.try_call('search', query=args[0],
+                keywords=args[1:],
+                exts=None if exts is None else sorted(exts),
+                limit=opts.limit, page=opts.page, use_index=opts.use_index,
+                use_cache=opts.use_cache, sniff=opts.sniff, jobs=opts.jobs)
+            if results is None:
+                cache = None
+                if opts.use_cache:
+                    from .querycache import QueryCache
+                    cache = QueryCache()
+
+                results = (len(args) > 0) and get_results(
+                    args[0], index=index, exts=search_exts,
+                    sniffer=sniffer, keywords=args[1:], limit=opts.limit,
+                    page=opts.page, cache=cache) or []
     else:
         results = [os.path.abspath(x) for x in args]
 
     # TODO: Decide whether to support locate without chooser
     if opts.random:
-        results = gather_random(results, opts.wanted_count)
-    elif opts.locate and not (opts.print_nl or opts.print_null):
+        sample = client and client.try_call('sample', roots=results,
+            count=opts.wanted_count, jobs=opts.jobs, seed=opts.seed,
+            exts=None if exts is None else sorted(exts), sniff=opts.sniff,
+            blacklist=sorted(blacklist), use_snapshot=opts.snapshot,
+            weights=weights,
+            per_album=opts.per_album, max_per_album=opts.max_per_album,
+            no_repeat=opts.no_repeat)
+        if sample is None:
+            snapshots = None
+            if opts.snapshot:
+                from .watch import get_snapshot
+                snapshots = [get_snapshot(x) for x in results]
+            sample = gather_random(results, opts.wanted_count,
+                                   jobs=opts.jobs, seed=opts.seed,
+                                   exts=exts, sniffer=sniffer,
+                                   snapshots=snapshots, weights=weights,
+                                   per_album=opts.per_album,
+                                   max_per_album=opts.max_per_album,
+                                   no_repeat=opts.no_repeat,
+                                   blacklist=blacklist)
+        results = sample
+    elif use_chooser:
         try:
             argv = cmd + ' ' + ' '.join(sys.argv[1:])
-            if UrwidChooser and opts.urwid:
-                chooser = UrwidChooser(argv, results)
+            if chooser_cls:
+                chooser = chooser_cls(argv, results)
                 results, opts.enqueue, opts.exe_cmd = chooser.run(
-                        opts.enqueue, opts.exe_cmd)
+                        opts.enqueue, opts.exe_cmd, stream=stream)
             else:
+                from .ui.fallback_chooser import choose
                 results, opts.enqueue = choose(
                     results, not opts.show_path, opts.enqueue)
         except KeyboardInterrupt:
             results = []
+        finally:
+            if stream:
+                stream.cancel()
     else:
         results = results
 
     # Branch for --exec, MPRIS, or fallback to print
-    if opts.exe_cmd:
-        add_func = lambda paths, play: subprocess.call(
-                                         shlex.split(opts.exe_cmd) + paths)
+    players = opts.players or preferred_players
+    printing = opts.print_quoted or opts.print_null or opts.print_nl
+    if printing:
+        add_func = None
+    elif opts.exe_cmd:
+        import shlex
+        from .output.command import run_batches
+        exe_argv = shlex.split(opts.exe_cmd)
+        add_func = lambda paths, play: run_batches(exe_argv, paths,
+                                                   opts.max_procs)
+    elif client and client.try_call('player', players=players):
+        from .daemon import DaemonError
+
+        def add_func(paths, play):
+            """Add through the daemon, or directly if it can't"""
+            try:
+                client.call('add', paths=paths, play=play, players=players)
+                return None  # main()'s result is the exit status
+            except (DaemonError, EnvironmentError), err:
+                log.warning("The daemon couldn't add to the player (%s). "
+                            "Connecting directly.", err)
+
+            try:
+                adder = get_mpris_adder(players)
+            except EnvironmentError, err:
+                log.error("Cannot connect to an MPRIS-compatible player: %s",
+                          err)
+                return 1
+            return adder(paths, play)
     else:
         try:
-            add_func = MPRISAdder().add_tracks
-        except (NameError, DBusException), err:
+            add_func = get_mpris_adder(players)
+        except EnvironmentError, err:
             print("Cannot connect to an MPRIS-compatible player. "
                   "Assuming --print.")
             print('\t%s' % err)
@@ -249,18 +681,24 @@ def main():
             opts.print_nl = True
 
     # Feed the results to the player
-    if opts.print_quoted:
-        print(' '.join(sh_quote(x) for x in results))
-    elif opts.print_null:
-        print('\0'.join(results))
-    elif opts.print_nl:
-        print('\n'.join(results))
-    elif results:
-        add_func(results, not opts.enqueue)
+    if opts.print_quoted or opts.print_null or opts.print_nl:
+        from .output.printer import sh_quote, write_results
+        if opts.print_quoted:
+            write_results(results, '', ' ', sh_quote)
+        else:
+            write_results(results, opts.print_null and '\0' or '\n')
+        return
+
+    # Drop stale and unreadable paths before a player or command sees them.
+    # Printed paths aren't checked since that would cost a stat() apiece.
+    from .validate import iter_valid
+    results = list(iter_valid(results))
+    if results:
+        return add_func(results, not opts.enqueue)
     else:
         print("No Results")
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
 
 # vim: set sw=4 sts=4 :
@@ -0,0 +1,31 @@
+"""Helpers for locating lap's on-disk caches and runtime files"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import errno, os
+
+def get_cache_dir():
+    """Return (and create if necessary) lap's XDG cache directory."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'lap')
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+    return path
+
+def get_cache_path(name):
+    """Return the path to the named file within L{get_cache_dir}."""
+    return os.path.join(get_cache_dir(), name)
+
+def get_runtime_path(name):
+    """Return the path to the named file in the user's XDG runtime
+    directory, falling back to L{get_cache_dir} if there isn't one."""
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if not base or not os.path.isdir(base):
+        return get_cache_path(name)
+    return os.path.join(base, name)
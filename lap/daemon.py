@@ -0,0 +1,295 @@
+"""Optional resident server which keeps lap's expensive state warm
+
+C{lap --daemon} listens on a Unix socket in C{$XDG_RUNTIME_DIR} and answers
+searches, random selections and MPRIS requests using a D-Bus connection,
+player proxies and imported modules that persist between calls. Every other
+invocation checks for the socket and, if it's there, hands its work over
+instead of doing it in-process. The choosers always run in the client.
+
+Messages are C{marshal}led and prefixed with their length. Since
+C{marshal} isn't safe against malicious input, the socket is only
+accessible to the user who started the daemon.
+
+For C{--snapshot} requests, the daemon also keeps a L{Watcher} running so
+the listings it samples from follow changes to the library as they happen.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import errno, logging, marshal, os, signal, socket, struct, sys, threading
+log = logging.getLogger(__name__)
+
+from .cache import get_runtime_path
+
+SOCKET_NAME = 'lap.sock'
+LENGTH = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+class DaemonError(Exception):
+    """Raised when the daemon reports that a request failed."""
+
+def get_socket_path():
+    """Return where the daemon's socket lives."""
+    return get_runtime_path(SOCKET_NAME)
+
+def _recv_exactly(sock, size):
+    """Read exactly C{size} bytes from C{sock}.
+
+    @raises EOFError: The connection closed first.
+    """
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 65536))
+        if not chunk:
+            raise EOFError("Connection closed mid-message")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, obj):
+    """Send a marshallable object as a single length-prefixed message."""
+    data = marshal.dumps(obj)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+def recv_message(sock):
+    """Receive a message sent by L{send_message}."""
+    size = LENGTH.unpack(_recv_exactly(sock, LENGTH.size))[0]
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError("Message too large: %d bytes" % size)
+    return marshal.loads(_recv_exactly(sock, size))
+
+class DaemonClient(object):
+    """Connection to a running L{LapDaemon}"""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def call(self, op, **kwargs):
+        """Perform C{op} in the daemon and return its result.
+
+        @raises DaemonError: The daemon couldn't perform the request.
+        @raises EnvironmentError: The connection was lost.
+        """
+        try:
+            send_message(self.sock, {'op': op, 'args': kwargs})
+            reply = recv_message(self.sock)
+        except (EOFError, ValueError), err:
+            raise EnvironmentError(err)
+        if not reply.get('ok'):
+            raise DaemonError(reply.get('error'))
+        return reply.get('result')
+
+    def try_call(self, op, **kwargs):
+        """Like L{call}, but log failures and return C{None} so the caller
+        can fall back to doing the work itself."""
+        try:
+            return self.call(op, **kwargs)
+        except (DaemonError, EnvironmentError), err:
+            log.debug("Daemon couldn't handle %r: %s", op, err)
+            return None
+
+def connect(path=None):
+    """Return a L{DaemonClient} or C{None} if no daemon is running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or get_socket_path())
+    except socket.error:
+        sock.close()
+        return None
+    return DaemonClient(sock)
+
+class LapDaemon(object):
+    """Server for the requests sent by L{DaemonClient}.
+
+    Each connection is handled in its own thread, but MPRIS calls are
+    serialized since they share one D-Bus connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_socket_path()
+        self.adders = {}
+        self.player_lock = threading.Lock()
+        self.sock = None
+        self.watcher = None
+        self.watcher_lock = threading.Lock()
+        self.pools = {}  # WeightedPools for the snapshots, by options
+
+    def _bind(self):
+        """Create the listening socket, replacing a stale one if needed."""
+        if os.path.exists(self.path):
+            if connect(self.path):
+                raise EnvironmentError(errno.EADDRINUSE, "A daemon is "
+                                       "already listening", self.path)
+            os.remove(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(16)
+
+    def serve_forever(self):
+        """Answer requests until interrupted or sent C{SIGTERM}."""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._bind()
+        log.info("Listening on %s", self.path)
+        try:
+            while True:
+                conn = self.sock.accept()[0]
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            if self.watcher:
+                with self.watcher.lock:
+                    self.watcher.save()
+
+    def handle(self, conn):
+        """Answer requests on C{conn} until the client disconnects."""
+        try:
+            while True:
+                try:
+                    request = recv_message(conn)
+                except EOFError:
+                    return
+
+                try:
+                    handler = getattr(self, 'op_' + request['op'])
+                    reply = {'ok': True,
+                             'result': handler(**request.get('args', {}))}
+                except EnvironmentError, err:  # eg. No player running
+                    log.info("Request failed: %r: %s", request['op'], err)
+                    reply = {'ok': False, 'error': str(err)}
+                except Exception, err:  # pylint: disable=broad-except
+                    log.exception("Request failed: %r", request.get('op'))
+                    reply = {'ok': False, 'error': '%s: %s' % (
+                        type(err).__name__, err)}
+                send_message(conn, reply)
+        except (socket.error, ValueError), err:
+            log.debug("Dropping client: %s", err)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def op_ping():
+        """Check that the daemon is alive."""
+        return True
+
+    @staticmethod
+    def _make_sniffer(sniff, exts, jobs, blacklist=None):
+        """Build a L{SniffFilter} for a request, if it asked for one.
+
+        @param blacklist: For C{--random} without C{--type}, the extensions
+            to reject. This also enables sniffing unknown extensions.
+        """
+        if not sniff:
+            return None
+        from .sniff import SniffFilter
+        return SniffFilter(None if exts is None else frozenset(exts),
+                           jobs=max(jobs, 4), sniff_unknown=bool(blacklist),
+                           blacklist=blacklist)
+
+    def op_search(self, query, keywords=(), exts=None, limit=None, page=1,
+                  use_index=False, use_cache=True, sniff=False, jobs=1):
+        """Run L{get_results} for a client."""
+        from .__main__ import get_results
+        from .filetypes import OK_EXTS
+
+        index = None
+        if use_index:
+            from .index import MediaIndex
+            index = MediaIndex()
+
+        cache = None
+        if use_cache:
+            from .querycache import QueryCache
+            cache = QueryCache()
+
+        try:
+            return get_results(query, index=index,
+                exts=OK_EXTS if exts is None else frozenset(exts),
+                sniffer=self._make_sniffer(sniff, exts, jobs),
+                keywords=list(keywords), limit=limit, page=page,
+                cache=cache)
+        finally:
+            if index:
+                index.close()
+
+    def _get_watcher(self):
+        """Return the L{Watcher}, starting it on first use."""
+        with self.watcher_lock:
+            if self.watcher is None:
+                from .watch import Watcher
+                self.watcher = Watcher()
+            return self.watcher
+
+    def op_sample(self, roots, count, jobs=1, seed=None, exts=None,
+                  sniff=False, use_snapshot=False, weights=(),
+                  per_album=False, max_per_album=None, no_repeat=False,
+                  blacklist=None):
+        """Run L{gather_random} for a client, reading from live snapshots
+        of C{roots} if C{use_snapshot} is set.
+
+        With snapshots, the L{WeightedPool} which weighted, per-album and
+        no-repeat selections need is kept until the library changes, so
+        later requests don't have to rebuild it.
+        """
+        from .__main__ import gather_random
+        from .filetypes import BLACKLISTED_EXTS
+        blacklist = (BLACKLISTED_EXTS if blacklist is None
+                     else frozenset(blacklist))
+        kwargs = dict(jobs=jobs, seed=seed,
+            exts=frozenset(exts) if exts is not None else None,
+            sniffer=self._make_sniffer(sniff, exts, jobs,
+                                       blacklist if exts is None else None),
+            weights=[tuple(x) for x in weights], per_album=per_album,
+            max_per_album=max_per_album, no_repeat=no_repeat,
+            blacklist=blacklist)
+        if not use_snapshot:
+            return gather_random(roots, count, **kwargs)
+
+        watcher = self._get_watcher()
+        snapshots = [watcher.get(x) for x in roots]
+        with watcher.lock:  # Hold off events while the lists are read
+            return gather_random(roots, count, snapshots=snapshots,
+                                 pools=self.pools, **kwargs)
+
+    def _get_adder(self, players):
+        """Return a cached C{add_tracks} function for the given player
+        preferences, connecting if necessary."""
+        from .__main__ import get_mpris_adder
+        key = tuple(players)
+        if key not in self.adders:
+            self.adders[key] = get_mpris_adder(list(players))
+        return self.adders[key]
+
+    def op_player(self, players=()):
+        """Make sure an MPRIS player can be reached."""
+        with self.player_lock:
+            self._get_adder(players)
+        return True
+
+    def op_add(self, paths, play=False, players=()):
+        """Add C{paths} to the player, reconnecting once if the cached
+        connection has gone stale (eg. the player was restarted).
+
+        Only failures from before anything was sent are retried, since
+        retrying a partial addition would duplicate tracks.
+        """
+        from .output.mpris import PlayerGoneError
+        with self.player_lock:
+            try:
+                self._get_adder(players)(paths, play)
+            except PlayerGoneError:
+                log.info("Reconnecting to the player", exc_info=True)
+                self.adders.pop(tuple(players), None)
+                self._get_adder(players)(paths, play)
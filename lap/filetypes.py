@@ -5,7 +5,8 @@ from __future__ import print_function, absolute_import
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2 or later"
 
-# TODO: Redesign this to support ack-like command-line filter options
+import os
+
 ADLIB_EXTS = ['.a2m', '.adl', '.amd', '.bam', '.cff', '.cmf', '.d00', '.dfm',
               '.dmo', '.dro', '.dtm', '.hsc', '.hsp', '.jbm', '.ksm', '.laa',
               '.lds', '.mad', '.mkj', '.msc', '.mtk', '.rad', '.raw', '.rix',
@@ -17,30 +18,92 @@ CONSOLE_EXTS = ['.adx', '.gbs', '.gym', '.hes', '.kss', '.nsf', '.nsfe', '.ay',
                 '.minipsf']
 
 # pylint: disable=bad-whitespace
+IMAGE_EXTS    = ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
 MIDI_EXTS     = ['.mid', '.rmi', '.midi']
-MODULE_EXTS   = [',mod', '.s3m', '.stm', '.xm', '.it']
+MODULE_EXTS   = ['.mod', '.s3m', '.stm', '.xm', '.it']
 PLAYLIST_EXTS = ['.cue', '.m3u', '.pls', '.xspf']
+TEXT_EXTS     = ['.txt', '.html', '.htm']
 VIDEO_FILES   = ['.avi', '.flv', '.m4v', '.mov', '.mp4', '.webm', '.rm']
 WAVEFORM_EXTS = ['.aac', '.ac3', '.aif', '.aiff', '.ape', '.au', '.flac',
                  '.m4a', '.mp2', '.mp3', '.mpc', '.ogg', '.shn', '.snd',
                  '.tta', '.voc', '.wav', '.wma', '.wv']
 
-# Edit these lines to choose the kind of files to be filtered for.
+# Named categories for use with the ack-style --type option
+FILETYPES = {
+    'adlib': ADLIB_EXTS,
+    'console': CONSOLE_EXTS,
+    'image': IMAGE_EXTS,
+    'midi': MIDI_EXTS,
+    'module': MODULE_EXTS,
+    'playlist': PLAYLIST_EXTS,
+    'text': TEXT_EXTS,
+    'video': VIDEO_FILES,
+    'waveform': WAVEFORM_EXTS,
+}
+
+# Edit this line to choose the kind of files to be filtered for.
 # By default, playlist extensions are excluded.
-OK_EXTS = (WAVEFORM_EXTS + MODULE_EXTS + CONSOLE_EXTS + MIDI_EXTS +
-           ADLIB_EXTS    + VIDEO_FILES)
+DEFAULT_TYPES = ['waveform', 'module', 'console', 'midi', 'adlib', 'video']
 # If you want true format filtering, YOU write the mimetype cache.
 
+def compile_exts(include=None, exclude=None):
+    """Resolve lists of category names from L{FILETYPES} into a set of
+    lowercase extensions for constant-time lookup.
+
+    @param include: Categories to start from. (default: L{DEFAULT_TYPES})
+    @param exclude: Categories to remove from the result.
+    @raises KeyError: An unknown category name was given.
+    @rtype: C{frozenset}
+    """
+    exts = set()
+    for name in (DEFAULT_TYPES if include is None else include):
+        exts.update(x.lower() for x in FILETYPES[name])
+    for name in exclude or ():
+        exts.difference_update(x.lower() for x in FILETYPES[name])
+    return frozenset(exts)
+
+def parse_type_args(type_args):
+    """Split ack-style C{--type} arguments into C{(include, exclude)} lists
+    for L{compile_exts}.
+
+    C{NAME} includes a category while C{noNAME} excludes it. If no category
+    is explicitly included, exclusions apply to L{DEFAULT_TYPES}.
+
+    @raises KeyError: An unknown category name was given.
+    """
+    include, exclude = [], []
+    for arg in type_args:
+        if arg not in FILETYPES and arg.startswith('no'):
+            exclude.append(arg[2:])
+        else:
+            include.append(arg)
+
+    for name in include + exclude:
+        if name not in FILETYPES:
+            raise KeyError(name)
+    return (include or None), exclude
+
+def has_ext(name, exts):
+    """Return C{True} if C{name}'s extension is in C{exts}, ignoring case.
+
+    All registered extensions are single-dot suffixes, so only the text
+    after the last dot needs to be looked up.
+    """
+    return os.path.splitext(name)[1].lower() in exts
+
+OK_EXTS = compile_exts()
+
 # Blacklist used for gather_random()
-BLACKLISTED_EXTS = [
-    '.m3u', '.pls', '.xspf'     # Playlists (just enqueue directly)
+BLACKLISTED_EXTS = frozenset([
+    '.m3u', '.pls', '.xspf',    # Playlists (just enqueue directly)
     '.jpg', '.jpeg', '.png', '.gif', '.bmp',  # Images (eg. Cover Art)
     '.txt', '.html', '.htm',    # Not media
     '.sid',                     # Capable of looping infinitely
     '.mid', '.midi', '.rmi',    # Require the keyboard to be turned on manually
-]
+])
 # Note: SID is actually blacklisted for two reasons:
 #  1. I have the entire HVSC and I don't want that to weight the randomization
 #     in favor of SIDs.
 #  2. All the SIDs I've encountered loop infinitely and I want my playlist to
 #     stop after a predictable interval.
+# (With --type and --weight, they can be included at a chosen share instead.)
@@ -0,0 +1,121 @@
+"""Persistent shuffle history for C{--random --no-repeat}
+
+Every file picked is recorded as an 8-byte hash of its path, appended to a
+file in the cache directory. Picks are made by rejection sampling against
+that set, so a run usually only hashes the files it draws rather than
+filtering the whole library. Near the end of a cycle, when draws keep
+hitting played files, the rest are hashed by a single weighted-shuffle
+pass, which also shows whether the cycle is over. Hashes are kept with the
+L{WeightedPool}, so the daemon only computes each one once. Once everything
+has been picked, the history is cleared and a new cycle begins.
+
+The history file is locked with C{flock()} from loading to saving, so
+overlapping runs (eg. from C{cron}) never pick the same file twice.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import fcntl, hashlib, logging, os
+log = logging.getLogger(__name__)
+
+from .cache import get_cache_path
+from .sampling import weighted_sample
+
+ID_SIZE = 8
+
+def path_id(path):
+    """Return the compact ID under which C{path} is recorded."""
+    return hashlib.sha1(path).digest()[:ID_SIZE]
+
+def get_history_path(roots):
+    """Return the history file for a given set of root paths."""
+    key = '\0'.join(sorted(os.path.abspath(x) for x in roots))
+    return get_cache_path('shuffle-%s' % hashlib.sha1(key).hexdigest()[:16])
+
+class ShuffleHistory(object):
+    """The set of paths already picked in the current cycle.
+
+    Use as a context manager. The file stays locked until it exits.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fobj = None
+        self.seen = set()
+
+    def __enter__(self):
+        self.fobj = open(self.path, 'a+b')
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_EX)
+        self.fobj.seek(0)
+        data = self.fobj.read()
+
+        usable = len(data) - len(data) % ID_SIZE
+        if usable != len(data):  # A previous run died mid-write
+            self.fobj.truncate(usable)
+        self.seen = set(data[x:x + ID_SIZE]
+                        for x in xrange(0, usable, ID_SIZE))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fobj.close()  # Also releases the lock
+        self.fobj = None
+
+    def __contains__(self, path):
+        return path_id(path) in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, paths):
+        """Record C{paths} as picked."""
+        new_ids = []
+        for path in paths:
+            new_id = path_id(path)
+            if new_id not in self.seen:
+                self.seen.add(new_id)
+                new_ids.append(new_id)
+        self.fobj.write(b''.join(new_ids))  # Always appends in 'a' mode
+        self.fobj.flush()
+
+    def reset(self):
+        """Start a new cycle."""
+        self.fobj.truncate(0)
+        self.seen.clear()
+
+def sample_unplayed(history, pool, count, **kwargs):
+    """Like L{weighted_sample} but skip items in C{history}, starting a new
+    cycle if there aren't enough left, and record the items chosen.
+
+    Extra keyword arguments are passed to L{weighted_sample}.
+    """
+    ids, unplayed = pool.memo, set()
+
+    def played(path):
+        """Check C{path} against the history, hashing it at most once per
+        pool and noting it if it hasn't been played"""
+        if path not in ids:
+            ids[path] = path_id(path)
+        if ids[path] in history.seen:
+            return True
+        unplayed.add(path)
+        return False
+
+    chosen = new = weighted_sample(pool, count, skip=played, **kwargs)
+
+    # Falling short means every item was checked, so the cycle is over
+    # unless a quota held back some unplayed ones. (Everything chosen was
+    # unplayed, so that's when there are more unplayed than chosen.)
+    if pool and len(chosen) < count and len(unplayed) == len(chosen):
+        log.info("Every file has been picked. Starting a new cycle.")
+        history.reset()
+
+        # What was already chosen finished the old cycle, but still counts
+        # towards this run's quotas.
+        new = weighted_sample(pool, count - len(chosen), picked=chosen,
+                              **kwargs)
+        chosen = chosen + new
+
+    history.add(new)
+    return chosen
@@ -0,0 +1,150 @@
+"""SQLite-backed index of media files for use in place of C{locate}
+
+The index only holds files matching L{OK_EXTS}, keyed by their lowercased
+path, and remembers each directory's mtime so that rescans only re-list
+directories whose contents have actually changed.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import logging, os, sqlite3
+log = logging.getLogger(__name__)
+
+from .cache import get_cache_path
+from .filetypes import OK_EXTS
+from .query import is_glob
+
+DEFAULT_INDEX_NAME = 'index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    lpath TEXT NOT NULL,
+    dir TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_lpath ON files (lpath);
+"""
+
+def _is_under(path, root):
+    """Return C{True} if C{path} is C{root} or somewhere inside it."""
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+class MediaIndex(object):
+    """Persistent, incrementally-updated index of media files.
+
+    @todo: Consider an FTS trigram table if plain C{instr()} scans ever
+           become the bottleneck.
+    """
+    def __init__(self, db_path=None, exts=OK_EXTS):
+        self.db_path = db_path or get_cache_path(DEFAULT_INDEX_NAME)
+        self.exts = exts
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.text_factory = str  # Paths are bytestrings. Keep them so.
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
+
+    def _is_media(self, name):
+        """Return C{True} if C{name} has one of the indexed extensions."""
+        return os.path.splitext(name)[1].lower() in self.exts
+
+    def _rescan_dir(self, path):
+        """Replace the indexed contents of C{path} with a fresh listing.
+
+        @returns: A list of subdirectories to descend into.
+        """
+        subdirs, files = [], []
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if os.path.isdir(full):
+                if not os.path.islink(full):
+                    subdirs.append(full)
+            elif self._is_media(name):
+                files.append((full, full.lower(), path))
+
+        self.conn.execute("DELETE FROM files WHERE dir = ?", (path,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO files (path, lpath, dir) VALUES (?, ?, ?)",
+            files)
+        return subdirs
+
+    def update(self, roots):
+        """Bring the index up to date for C{roots}.
+
+        Only directories whose mtime differs from the recorded value are
+        re-listed. Unchanged directories are traversed using the recorded
+        directory tree, so an unchanged library costs one C{stat} per
+        directory and no C{listdir} calls at all.
+
+        @type roots: C{list} of C{basestring}
+        """
+        roots = [os.path.abspath(x) for x in roots]
+        known = dict((path, mtime) for path, mtime in
+                     self.conn.execute("SELECT path, mtime FROM dirs")
+                     if any(_is_under(path, x) for x in roots))
+
+        children = {}
+        for path in known:
+            children.setdefault(os.path.dirname(path), []).append(path)
+
+        seen, rescanned = set(), 0
+        with self.conn:
+            stack = list(roots)
+            while stack:
+                path = stack.pop()
+                if path in seen:
+                    continue
+
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError, err:
+                    log.debug("Skipping unreadable directory %s: %s",
+                              path, err)
+                    continue
+                seen.add(path)
+
+                if known.get(path) == mtime:
+                    stack.extend(children.get(path, []))
+                    continue
+
+                try:
+                    stack.extend(self._rescan_dir(path))
+                except OSError, err:
+                    log.debug("Could not list %s: %s", path, err)
+                    continue
+                self.conn.execute("INSERT OR REPLACE INTO dirs (path, mtime) "
+                                  "VALUES (?, ?)", (path, mtime))
+                rescanned += 1
+
+            stale = [(x,) for x in known if x not in seen]
+            self.conn.executemany("DELETE FROM files WHERE dir = ?", stale)
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", stale)
+
+        log.info("Index updated: %d directories rescanned, %d removed",
+                 rescanned, len(stale))
+
+    def search(self, query):
+        """Return all indexed paths matching C{query}, case-insensitively.
+
+        Like C{locate}, plain strings are matched as substrings while
+        patterns containing glob characters must match the whole path.
+        """
+        query = query.lower()
+        if is_glob(query):
+            cursor = self.conn.execute(
+                "SELECT path FROM files WHERE lpath GLOB ?", (query,))
+        else:
+            cursor = self.conn.execute(
+                "SELECT path FROM files WHERE instr(lpath, ?) > 0", (query,))
+        return [row[0] for row in cursor]
@@ -0,0 +1,134 @@
+"""Direct reader for C{mlocate} databases
+
+Rather than spawning C{locate} and parsing every line it prints, this
+memory-maps the database and lets a single compiled regular expression walk
+its records in place so that only entries with a wanted extension ever get
+turned into Python strings.
+
+See C{mlocate.db(5)} for the format. C{plocate} databases are compressed and
+can't be walked in place, so they're detected and rejected, leaving the
+caller to fall back to running C{locate}.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import fnmatch, logging, mmap, os, re, struct
+log = logging.getLogger(__name__)
+
+from .filetypes import MODULE_EXTS, OK_EXTS
+from .query import is_glob
+
+MLOCATE_MAGIC = '\0mlocate'
+PLOCATE_MAGIC = '\0plocate'
+
+# magic, configuration block size, format version, require_visibility, pad
+HEADER = struct.Struct('>8sIBB2x')
+
+class UnsupportedDatabase(ValueError):
+    """Raised when a file isn't an mlocate database we can walk in place."""
+
+def _make_pattern(exts, misnamed=False):
+    """Build a regex matching directory headers and wanted file entries.
+
+    Each record is preceded by the NUL which terminated the previous one, so:
+     - C{\\0\\2} is an end-of-directory marker followed by the next
+       directory's 16-byte timestamp header and its absolute path.
+     - C{\\0\\0} is the start of a non-directory entry, whose name can't
+       contain C{/}. Only names ending in one of C{exts} are matched.
+
+    Terminating NULs are matched with lookahead so they remain available as
+    the lead-in for the following record.
+
+    @param misnamed: Also match names with no extension or with an
+        Amiga-style module prefix (eg. C{mod.songname}) so they can be
+        sniffed.
+    """
+    suffixes = '|'.join(re.escape(x.lstrip('.')) for x in
+                        sorted(exts, key=len, reverse=True)) or '(?!)'
+    name_re = r'[^\x00/]*\.(?:%s)' % suffixes
+    if misnamed:
+        name_re += r'|[^\x00/.]+|(?:%s)\.[^\x00/]*' % '|'.join(
+            re.escape(x.lstrip('.')) for x in MODULE_EXTS)
+    return re.compile(r'(?s)\x00\x02.{16}(?P<dir>/[^\x00]*)(?=\x00)'
+                      r'|\x00\x00(?P<name>%s)(?=\x00)'
+                      % name_re, re.IGNORECASE)
+
+class MLocateDB(object):
+    """Memory-mapped, read-only view of an mlocate database."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as fobj:
+            try:
+                self.mmap = mmap.mmap(fobj.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                raise UnsupportedDatabase("Empty database: %s" % path)
+
+        if self.mmap[:len(PLOCATE_MAGIC)] == PLOCATE_MAGIC:
+            raise UnsupportedDatabase("plocate databases are compressed and "
+                                      "can't be read in place: %s" % path)
+
+        magic, conf_size, version, self.require_visibility = \
+            HEADER.unpack_from(self.mmap)
+        if magic != MLOCATE_MAGIC or version != 0:
+            raise UnsupportedDatabase("Not an mlocate v0 database: %s" % path)
+
+        # Skip the database root path and the configuration block to reach
+        # the first directory header, which has no end marker before it.
+        root_end = self.mmap.find('\0', HEADER.size)
+        self.first_dir = root_end + 1 + conf_size
+
+    def close(self):
+        """Release the memory mapping."""
+        self.mmap.close()
+
+    def _is_visible(self, path):
+        """Emulate mlocate's check that the caller may see C{path}'s files."""
+        return (not self.require_visibility or
+                os.access(path, os.R_OK | os.X_OK))
+
+    def search(self, queries, exts=OK_EXTS, misnamed=False):
+        """Yield paths with extensions in C{exts} which match any of
+        C{queries} case-insensitively, in database order.
+
+        Like C{locate}, plain strings are matched as substrings while
+        patterns containing glob characters must match the whole path.
+
+        @param misnamed: Passed through to L{_make_pattern}.
+        """
+        if isinstance(queries, basestring):
+            queries = [queries]
+        queries = [x.lower() for x in queries]
+        globs = [x for x in queries if is_glob(x)]
+        substrs = [x for x in queries if not is_glob(x)]
+
+        def matches(path):
+            """Test a (lowercased) path against C{queries}"""
+            return (any(x in path for x in substrs) or
+                    any(fnmatch.fnmatchcase(path, x) for x in globs))
+
+        # The first directory header isn't preceded by an end marker, so
+        # fake up the state the regex would otherwise have produced.
+        header_end = self.first_dir + 16
+        cur_dir = self.mmap[header_end:self.mmap.find('\0', header_end)]
+        prefix, visible = None, None
+
+        pattern = _make_pattern(exts, misnamed)
+        for match in pattern.finditer(self.mmap, header_end):
+            name = match.group('name')
+            if name is None:
+                cur_dir, prefix, visible = match.group('dir'), None, None
+                continue
+
+            if prefix is None:
+                prefix = cur_dir.rstrip('/') + '/'
+            path = prefix + name
+
+            if matches(path.lower()):
+                if visible is None:
+                    visible = self._is_visible(cur_dir)
+                if visible:
+                    yield path
@@ -0,0 +1,123 @@
+"""xargs-like dispatch of paths to an arbitrary command"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import errno, logging, os, subprocess
+from multiprocessing.pool import ThreadPool
+log = logging.getLogger(__name__)
+
+# POSIX's guaranteed minimum, for systems which won't tell us
+FALLBACK_ARG_MAX = 4096
+
+# Like xargs, leave some slack for anything the kernel or libc adds
+ARG_HEADROOM = 2048
+
+# Every argument and environment string also costs a pointer in argv/envp
+POINTER_SIZE = 8
+
+def get_arg_limit(env=None):
+    """Return how many bytes of arguments a new process can be given.
+
+    This is C{ARG_MAX} minus what the environment (C{env} or
+    C{os.environ}) and some headroom will use.
+    """
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = FALLBACK_ARG_MAX
+
+    env = os.environ if env is None else env
+    env_size = sum(len(key) + len(value) + 2 + POINTER_SIZE
+                   for key, value in env.items())
+    return arg_max - env_size - ARG_HEADROOM
+
+def make_batches(cmd, paths, limit=None, skipped=None):
+    """Split C{paths} into consecutive batches which, appended to C{cmd},
+    fit within C{limit} bytes. (default: L{get_arg_limit})
+
+    @param skipped: If provided, paths too long to ever run are appended to
+        this list and left out rather than raising C{ValueError}.
+    @raises ValueError: C{cmd} alone, or C{cmd} plus a single path, is too
+        long to ever run.
+    """
+    limit = get_arg_limit() if limit is None else limit
+    base = sum(len(x) + 1 + POINTER_SIZE for x in cmd)
+
+    batch, size = [], base
+    for path in paths:
+        cost = len(path) + 1 + POINTER_SIZE
+        if base + cost > limit:
+            if skipped is None:
+                raise ValueError("Argument list too long: %s" % path)
+            skipped.append(path)
+            continue
+        if batch and size + cost > limit:
+            yield batch
+            batch, size = [], base
+        batch.append(path)
+        size += cost
+    if batch:
+        yield batch
+
+def _call(argv):
+    """Run C{argv} and return its exit status, using xargs's codes for
+    commands which couldn't be run at all."""
+    try:
+        return subprocess.call(argv)
+    except OSError, err:
+        log.error("Could not run %s: %s", argv[0], err)
+        return 127 if err.errno == errno.ENOENT else 126
+
+def combine_statuses(statuses):
+    """Summarize several exit statuses as xargs(1) does.
+
+    @returns: 0 if everything succeeded, 127 or 126 if the command couldn't
+        be found or run, 125 if one was killed by a signal, 124 if one
+        exited with status 255, or 123 for any other failure.
+    """
+    statuses = set(statuses)
+    for code in (127, 126):
+        if code in statuses:
+            return code
+    if any(x < 0 for x in statuses):
+        return 125
+    elif 255 in statuses:
+        return 124
+    elif statuses - set([0]):
+        return 123
+    return 0
+
+def run_batches(cmd, paths, max_procs=1):
+    """Run C{cmd} on C{paths}, splitting them up to avoid C{E2BIG}.
+
+    Batches are always formed and started in the order of C{paths}. With
+    the default C{max_procs} of 1, each one also finishes before the next
+    starts, which is what order-sensitive commands like enqueueing need.
+
+    Like xargs, paths too long to pass to C{cmd} are reported and, unless
+    something worse happened, turn a successful run's status into 1.
+
+    @param max_procs: How many batches may run at once.
+    @returns: The combined exit status from L{combine_statuses}.
+    """
+    skipped = []
+    argvs = [cmd + batch for batch in make_batches(cmd, paths,
+                                                   skipped=skipped)]
+    for path in skipped:
+        log.error("Argument list too long. Skipping %s", path)
+
+    if max_procs <= 1 or len(argvs) <= 1:
+        statuses = [_call(x) for x in argvs]
+    else:
+        pool = ThreadPool(min(max_procs, len(argvs)))
+        try:
+            # chunksize=1 so the pool hands out batches strictly in order
+            statuses = pool.map(_call, argvs, 1)
+        finally:
+            pool.close()
+    return combine_statuses(statuses) or (1 if skipped else 0)
@@ -5,13 +5,113 @@ from __future__ import print_function, absolute_import
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2 or later"
 
-import logging, os, sys
+import json, logging, os, sys
 log = logging.getLogger(__name__)
 
 import dbus
 from dbus.exceptions import DBusException
 import xml.etree.cElementTree as ET
 
+from ..cache import get_cache_path
+
+DEFAULT_PLAYER_CACHE_NAME = 'players.json'
+
+# Use a GLib main loop to collect replies to pipelined calls if available
+try:
+    from dbus.mainloop.glib import DBusGMainLoop
+    try:
+        from gi.repository.GLib import MainLoop
+    except ImportError:
+        from gobject import MainLoop
+except ImportError:
+    DBusGMainLoop, MainLoop = None, None
+
+class PlayerGoneError(DBusException):
+    """The player couldn't be reached before anything was sent to it, so
+    the request can safely be retried after reconnecting."""
+
+class CallPipeline(object):
+    """Issue a sequence of D-Bus calls without waiting on each reply.
+
+    With a main loop, replies are collected asynchronously so errors can be
+    reported. Without one, calls are sent with C{ignore_reply} and L{wait}
+    relies on the bus delivering messages from one connection in order, so a
+    single blocking call at the end can't return before the rest have been
+    handled.
+
+    @param loop: An object with C{run()} and C{quit()} methods (eg. a GLib
+        C{MainLoop}) which dispatches replies for the bus being called.
+    """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.pending, self.errors = 0, []
+
+    def call(self, method, *args):
+        """Send a call to C{method} with C{args} and return immediately."""
+        if self.loop:
+            self.pending += 1
+            method(*args, reply_handler=self._on_reply,
+                   error_handler=self._on_error)
+        else:
+            method(*args, ignore_reply=True)
+
+    def _on_reply(self, *_):
+        """Count a reply and stop waiting once all have arrived"""
+        self.pending -= 1
+        if not self.pending:
+            self.loop.quit()
+
+    def _on_error(self, err):
+        """Record an error reply"""
+        self.errors.append(err)
+        self._on_reply()
+
+    def wait(self, barrier):
+        """Block until every call has been handled.
+
+        @param barrier: A blocking D-Bus method to call on the same
+            connection when no main loop is available.
+        """
+        if self.loop:
+            if self.pending:
+                self.loop.run()
+        else:
+            barrier()
+
+        for err in self.errors:
+            log.error("D-Bus call failed: %s", err)
+
+class PlayerCache(object):
+    """JSON-backed record of which player was chosen on each session bus
+
+    This lets L{MPRISAdder} skip C{ListNames} and introspecting every
+    candidate in the common case where the same player is still running.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_cache_path(DEFAULT_PLAYER_CACHE_NAME)
+
+    def _load(self):
+        """Read the whole cache, treating a missing or corrupt one as empty"""
+        try:
+            with open(self.path) as fobj:
+                return json.load(fobj)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Return the cached player record for C{key}, if any."""
+        return self._load().get(key)
+
+    def put(self, key, record):
+        """Store C{record} as the player for C{key}."""
+        cache = self._load()
+        cache[key] = record
+        try:
+            with open(self.path, 'w') as fobj:
+                json.dump(cache, fobj)
+        except IOError, err:
+            log.debug("Could not save player cache: %s", err)
+
 class MPRISAdder(object):
     """Convenience wrapper for accessing MPRIS AddTrack via D-Bus.
     @todo: Blog about the tasks within this. I had to piece it together.
@@ -20,43 +120,127 @@ class MPRISAdder(object):
     """
     ifname = 'org.freedesktop.MediaPlayer'
 
-    def __init__(self, bus=None):
+    def __init__(self, bus=None, preferred=None, cache=None, mainloop=None):
         """
-        @todo: Support a configurable preference for a specific player
+        @param bus: A bus to use instead of the session bus.
+        @param preferred: Player names (eg. C{audacious} or
+            C{org.mpris.audacious}) to try before any others, in order.
+        @param cache: A L{PlayerCache} to use instead of the default one.
+        @param mainloop: A callable returning a new main loop (see
+            L{CallPipeline}) which dispatches replies for C{bus}, so calls
+            are pipelined with error reporting. By default, this is GLib's
+            if available and C{bus} wasn't given.
         @todo: Make sure I properly support both MPRIS1 and MPRIS2.
         """
+        # Only collect asynchronous replies on a bus a loop is attached to
+        if bus is None and mainloop is None and DBusGMainLoop and MainLoop:
+            bus = dbus.Bus(dbus.Bus.TYPE_SESSION, mainloop=DBusGMainLoop())
+            mainloop = MainLoop
+        self.mainloop = mainloop
         self.bus = bus or dbus.Bus(dbus.Bus.TYPE_SESSION)
+        self.bus_if = self._get_dbus_if(
+            'org.freedesktop.DBus', '/', 'org.freedesktop.DBus')
+
+        self.preferred = [x if x.startswith('org.mpris.') else
+                          'org.mpris.' + x for x in preferred or []]
+        self.cache = cache or PlayerCache()
+
+        cache_key = self._cache_key()
+        player = cache_key and self.cache.get(cache_key)
+        if not (player and self._is_current(player)):
+            player = self.discover()
+            if cache_key:
+                self.cache.put(cache_key, player)
+        self._connect(player)
+
+    def _cache_key(self):
+        """Identify the session bus and player preferences for L{PlayerCache}
 
+        Without C{$DBUS_SESSION_BUS_ADDRESS}, the bus is identified by the
+        ID its daemon reports instead.
+        """
+        address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+        if not address:
+            try:
+                address = 'id:' + self.bus_if.GetId()
+            except DBusException, err:
+                log.debug("Can't identify the session bus: %s", err)
+                return None
+        return '|'.join([address] + self.preferred)
+
+    def _is_current(self, player):
+        """Return C{True} if a cached player record can still be used.
+
+        If the player still has the same unique name, it's the same process,
+        so its capabilities can't have changed, but a more preferred player
+        may have started since it was chosen.
+        """
+        if self.get_name_owner(player['name']) != player['owner']:
+            return False
+
+        rank = (self.preferred.index(player['name'])
+                if player['name'] in self.preferred else len(self.preferred))
+        for name in self.preferred[:rank]:
+            if self.get_name_owner(name):
+                log.debug("Preferred player %s is now running", name)
+                return False
+        return True
+
+    def _connect(self, player):
+        """Set up proxies for a player record from L{discover}"""
+        name = player['name']
+        self.iface = self._get_dbus_if(name, '/TrackList', self.ifname)
+
+        # FIXME: Figure out why qdbusviewer can introspect this but I
+        # can't. (Could be related to how qdbus segfaults calling it)
+        if player['type'] == 'audacious':
+            # pylint: disable=bad-continuation
+            atheme = self._get_dbus_if(name,
+                '/org/atheme/audacious', 'org.atheme.audacious')
+            self.pq_add = atheme.PlayqueueAdd
+            self.add_list = atheme.AddList
+        else:
+            self.pq_add, self.add_list = None, None
+
+    def discover(self):
+        """Find the most preferred player which supports MPRIS AddTrack.
+
+        @returns: A C{dict} suitable for L{PlayerCache}
+        """
         for name in self.get_player_names():
             iface = self._get_dbus_if(name, '/TrackList', self.ifname)
             if 'AddTrack' in self.get_method_names(iface):
-                self.iface = iface
-
-                # FIXME: Figure out why qdbusviewer can introspect this but I
-                # can't. (Could be related to how qdbus segfaults calling it)
-                if name == 'org.mpris.audacious':
-                    # pylint: disable=bad-continuation
-                    self.pq_add = self._get_dbus_if(name,
-                        '/org/atheme/audacious',
-                        'org.atheme.audacious').PlayqueueAdd
-                else:
-                    self.pq_add = lambda x: None
-
-                break
-        else:
-            raise DBusException("No media player with MPRIS AddTrack found")
+                return {
+                    'name': name,
+                    'owner': self.get_name_owner(name),
+                    'type': ('audacious' if name == 'org.mpris.audacious'
+                             else 'generic'),
+                }
+        raise DBusException("No media player with MPRIS AddTrack found")
 
     def _get_dbus_if(self, name, path, interface):
-        """Shorthand wrapper to retrieve a C{dbus.Interface}"""
-        obj = self.bus.get_object(name, path)
+        """Shorthand wrapper to retrieve a C{dbus.Interface}
+
+        Proxies are created without introspection since that would cost an
+        extra round-trip before the first call on each of them.
+        """
+        obj = self.bus.get_object(name, path, introspect=False)
         return dbus.Interface(obj, dbus_interface=interface)
 
+    def get_name_owner(self, name):
+        """Return the unique bus name currently owning C{name} or C{None}"""
+        try:
+            return self.bus_if.GetNameOwner(name)
+        except DBusException:
+            return None
+
     def get_player_names(self):
-        """Find all D-Bus names for MPRIS-compatible players"""
-        # pylint: disable=bad-continuation
-        ispect_if = self._get_dbus_if(
-                'org.freedesktop.DBus', '/', 'org.freedesktop.DBus')
-        return [x for x in ispect_if.ListNames() if x.startswith('org.mpris.')]
+        """Find all D-Bus names for MPRIS-compatible players, with those in
+        C{self.preferred} first."""
+        names = [x for x in self.bus_if.ListNames()
+                 if x.startswith('org.mpris.')]
+        rank = dict((x, pos) for pos, x in enumerate(self.preferred))
+        return sorted(names, key=lambda x: rank.get(x, len(rank)))
 
     def get_method_names(self, interface):
         """Get all method names within C{self.ifname} on the given interface.
@@ -69,19 +253,51 @@ class MPRISAdder(object):
         funcs = dom.findall(".//interface[@name='" + self.ifname + "']/method")
         return [x.get('name') for x in funcs]
 
+    @staticmethod
+    def _to_url(path):
+        """Convert a local path into a C{file://} URL for the player"""
+        if isinstance(path, str):
+            path = path.decode(sys.getfilesystemencoding())
+        return 'file://' + path
+
     def add_tracks(self, paths, play=False):
         """Add the given tracks to the player's playlist and, C{if play=True},
         start the first one playing.
+
+        Calls are pipelined rather than waiting on each reply, the playlist
+        length is only requested once, and a bulk method is used for the
+        tracks which aren't being played if the player has one.
+
+        @raises PlayerGoneError: The player couldn't be reached, so nothing
+            was added.
         """
-        for path in paths:
-            if not os.path.exists(path):
-                log.error("File does not exist: %s", path)
-
-            if isinstance(path, str):
-                path = path.decode(sys.getfilesystemencoding())
-            file_url = 'file://' + path
-
-            self.iface.AddTrack(file_url, play)
-            if self.pq_add and not play:
-                self.pq_add(self.iface.GetLength() - 1)
-            play = False  # Only start the first one playing
+        urls = [self._to_url(x) for x in paths]
+        if not urls:
+            return
+
+        pipeline = CallPipeline(self.mainloop and self.mainloop())
+        try:
+            # Also confirms the player is still there before sending
+            # anything which a retry could duplicate
+            start = self.iface.GetLength()
+        except DBusException, err:
+            raise PlayerGoneError(err)
+
+        # Only start the first one playing
+        first = 1 if play else 0
+        if play:
+            pipeline.call(self.iface.AddTrack, urls[0], True)
+
+        if self.add_list and len(urls) > first:
+            pipeline.call(self.add_list, urls[first:])
+        else:
+            for url in urls[first:]:
+                pipeline.call(self.iface.AddTrack, url, False)
+
+        # Queue everything but the track being played, tracking positions
+        # locally rather than asking for the new length after each addition.
+        if self.pq_add:
+            for pos in range(start + first, start + len(urls)):
+                pipeline.call(self.pq_add, pos)
+
+        pipeline.wait(self.iface.GetLength)
@@ -0,0 +1,71 @@
+"""Incremental output of results for shell pipelines"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import errno, io, re, sys
+
+BUFFER_SIZE = 64 * 1024
+
+_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9!@%_\-+=:,./]')
+_FUNNY_RE = re.compile(r'(["`$\\])')  # Unsafe inside "double quotes"
+
+def sh_quote(text):
+    """Reliably quote a string as a single argument for /bin/sh
+
+    Borrowed from the pipes module in Python 2.6.2 stdlib and fixed to quote
+    empty strings properly and pass completely safechars strings through.
+    """
+    if not text:
+        return "''"
+    elif not _UNSAFE_RE.search(text):
+        return text
+    elif '\'' not in text:
+        return '\'' + text + '\''
+    return '"' + _FUNNY_RE.sub(r'\\\1', text) + '"'
+
+def write_results(results, terminator='\n', separator='', quote=None,
+                  stream=None):
+    """Write C{results} to C{stream} (default: stdout) as they're produced.
+
+    Output goes through a large binary buffer rather than being joined
+    into one string first, so memory use stays flat and consumers like
+    C{xargs} can start on the first results right away.
+
+    @param terminator: Written after each result. (eg. C{'\\0'} for
+        C{xargs -0})
+    @param separator: Written between results. (eg. C{' '} with a
+        C{terminator} of C{''} for a single line)
+    @param quote: If provided, a function applied to each result.
+    @param stream: An open file. It's flushed first and, as with
+        C{sys.stdout}, is only written to via its file descriptor.
+    """
+    stream = stream or sys.stdout
+    stream.flush()
+    out = io.open(stream.fileno(), 'wb', BUFFER_SIZE, closefd=False)
+    try:
+        first = True
+        for result in results:
+            if quote:
+                result = quote(result)
+            if separator and not first:
+                out.write(separator)
+            out.write(result)
+            if terminator:
+                out.write(terminator)
+            first = False
+
+        if separator and not terminator:
+            out.write('\n')
+        out.flush()
+    except IOError, err:
+        if err.errno != errno.EPIPE:
+            raise
+        # The reader went away (eg. `| head`). That's not an error.
+    finally:
+        try:
+            out.close()
+        except IOError:  # Nowhere left to flush the rest to
+            pass
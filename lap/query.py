@@ -0,0 +1,157 @@
+"""Keyword matching with C{locate}-compatible semantics"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import fnmatch, heapq, itertools, re
+
+GLOB_CHARS = '*?['
+
+def is_glob(pattern):
+    """Return C{True} if C{locate} would treat C{pattern} as a glob rather
+    than a substring."""
+    return any(x in pattern for x in GLOB_CHARS)
+
+def _translate(pattern):
+    """Wrap C{fnmatch.translate} so its output can be embedded in a larger
+    regex on both Python 2 and 3."""
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('(?ms)'):  # Python 2 appends its flags
+        regex = regex[:-5]
+    return regex
+
+def compile_keywords(keywords):
+    """Compile an implicit AND of C{keywords} into a single predicate.
+
+    As with C{locate}, keywords without glob characters match anywhere in
+    the path while globs must match the whole path. Matching is
+    case-insensitive and each path is only lowercased once.
+
+    @returns: A callable which takes a path and returns a C{bool}.
+    """
+    keywords = [x.lower() for x in keywords]
+    substrs = [x for x in keywords if not is_glob(x)]
+    globs = [x for x in keywords if is_glob(x)]
+
+    # Plain substrings are left to str.__contains__ since, in CPython, that
+    # beats any automaton we could build in pure Python.
+    globs_match = None
+    if globs:
+        globs_match = re.compile('(?s)' + ''.join(
+            '(?=%s)' % _translate(x) for x in globs)).match
+
+    def matches(path):
+        """Test C{path} against every keyword"""
+        path = path.lower()
+        for substr in substrs:
+            if substr not in path:
+                return False
+        return globs_match is None or globs_match(path) is not None
+    return matches
+
+def compile_ranking(keywords):
+    """Compile C{keywords} into a sort key which puts the most relevant
+    paths first.
+
+    A keyword found in the basename scores higher than one only found in a
+    directory name and a hit at the start of a word scores higher than one
+    in the middle of it. Ties go to the shallower path, then alphabetical
+    order. Globs are only used for matching, so they don't affect the rank.
+
+    @returns: A callable which takes a path and returns a sortable key.
+    """
+    starts = [(x, re.compile(r'(?<![^\W_])' + re.escape(x)).search)
+              for x in (y.lower() for y in keywords) if not is_glob(x)]
+
+    def rank_key(path):
+        """Return a key which sorts better matches first"""
+        lpath = path.lower()
+        cut = lpath.rfind('/') + 1
+        dirname, basename = lpath[:cut], lpath[cut:]
+
+        score = 0
+        for substr, word_start in starts:
+            if substr in basename:
+                score += 6 if word_start(basename) else 4
+            elif substr in dirname:
+                score += 2 if word_start(dirname) else 1
+        return -score, lpath.count('/'), path
+    return rank_key
+
+def rank_results(paths, keywords, limit, page=1):
+    """Return the given C{page} of the C{limit} best matches in C{paths}
+    for C{keywords}, best first.
+
+    Only C{page * limit} results are ever held in memory, rather than every
+    match, so broad queries stay cheap.
+
+    @returns: C{(results, total)} where C{total} is the number of paths
+        which were considered.
+    """
+    counter = itertools.count()
+    counted = (path for path, _ in itertools.izip(paths, counter))
+    best = heapq.nsmallest(page * limit, counted,
+                           key=compile_ranking(keywords))
+    return best[(page - 1) * limit:], next(counter)
+
+class IncrementalFilter(object):
+    """Case-insensitive substring filter for a fixed list of strings which
+    is re-run on every keystroke.
+
+    Results are kept on a stack of C{(query, matches)} pairs. When the query
+    grows, only the previous matches need to be searched and, when it
+    shrinks, a wider result set is usually already on the stack.
+    """
+    def __init__(self, choices):
+        self.choices = choices
+        self._lowered = None
+        self._stack = [('', None)]
+
+    def _encode(self, query):
+        """Make C{query} the same string type as C{choices} so comparisons
+        don't trigger implicit (and fallible) decoding."""
+        if self.choices and isinstance(query, unicode) and not isinstance(
+                self.choices[0], unicode):
+            return query.encode('utf-8')
+        return query
+
+    def prepare(self):
+        """Lowercase the choices ahead of time so the first keystroke
+        doesn't have to."""
+        if self._lowered is None:
+            self._lowered = [x.lower() for x in self.choices]
+
+    def extend(self, start):
+        """Account for C{choices[start:]} having been appended."""
+        if self._lowered is None:
+            return
+        self._lowered.extend(x.lower() for x in self.choices[start:])
+
+        # Each level only needs to check the new matches of the level below
+        lowered, candidates = self._lowered, xrange(start, len(self.choices))
+        for query, matches in self._stack[1:]:
+            candidates = [idx for idx in candidates if query in lowered[idx]]
+            matches.extend(candidates)
+
+    def update(self, query):
+        """Return the indices of the choices containing C{query}, or
+        C{None} if the query is empty and everything matches."""
+        query = self._encode(query.lower())
+        stack = self._stack
+        while len(stack) > 1 and stack[-1][0] not in query:
+            stack.pop()
+
+        base_query, base = stack[-1]
+        if query == base_query:
+            return base
+
+        self.prepare()
+        lowered = self._lowered
+        if base is None:
+            base = xrange(len(lowered))
+
+        matches = [idx for idx in base if query in lowered[idx]]
+        stack.append((query, matches))
+        return matches
@@ -0,0 +1,112 @@
+"""Small on-disk LRU cache of search results
+
+Entries are stored with C{marshal}, which loads a list of strings far faster
+than re-parsing C{locate} output, and are tagged with the mtimes of the
+databases they were computed from so that they go stale as soon as
+C{updatedb} or C{--update-index} changes anything.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import errno, hashlib, logging, marshal, os
+log = logging.getLogger(__name__)
+
+from .cache import get_cache_path
+
+DEFAULT_CACHE_NAME = 'queries'
+DEFAULT_MAX_ENTRIES = 8
+
+# Databases `locate` might be reading when we can't tell which one it uses
+LOCATE_DB_PATHS = ['/var/lib/mlocate/mlocate.db',
+                   '/var/lib/plocate/plocate.db',
+                   '/var/lib/locate/locatedb',
+                   '/var/cache/locate/locatedb']
+
+def get_stamp(paths):
+    """Return a value which changes whenever any of C{paths} is modified,
+    created or removed."""
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stamp.append((path, stat.st_mtime, stat.st_size))
+    return tuple(stamp)
+
+class QueryCache(object):
+    """Directory of marshalled result lists, evicted least recently used
+    first."""
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path or get_cache_path(DEFAULT_CACHE_NAME)
+        self.max_entries = max_entries
+        try:
+            os.makedirs(self.path)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _entry_path(self, key):
+        """Map an arbitrary (marshallable) key to a file in the cache"""
+        return os.path.join(self.path,
+                            hashlib.sha1(marshal.dumps(key)).hexdigest())
+
+    def get(self, key, stamp):
+        """Return the results stored for C{key} or C{None} if there are
+        none or they were stored under a different C{stamp}."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as fobj:
+                old_stamp, results = marshal.load(fobj)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if old_stamp != stamp:
+            log.debug("Discarding stale cache entry %s", path)
+            self._remove(path)
+            return None
+
+        try:
+            os.utime(path, None)  # Mark as recently used
+        except OSError:
+            pass
+        return results
+
+    def put(self, key, stamp, results):
+        """Store C{results} for C{key}, evicting old entries if needed."""
+        path = self._entry_path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fobj:
+                marshal.dump((stamp, list(results)), fobj)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), err:
+            log.debug("Could not cache results for %r: %s", key, err)
+            self._remove(tmp_path)
+            return
+        self._evict()
+
+    @staticmethod
+    def _remove(path):
+        """Remove a cache file, ignoring errors"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove the least recently used entries beyond C{max_entries}"""
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            self._remove(path)
@@ -0,0 +1,224 @@
+"""Random sampling helpers for C{gather_random}"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import hashlib, heapq, itertools, os, random
+from collections import Counter
+
+from .filetypes import FILETYPES
+
+# How many draws L{weighted_sample} may reject (already chosen or over
+# quota) per requested item before falling back to a full pass
+REJECTION_BUDGET = 16
+
+def reservoir_sample(iterable, count, rng=random):
+    """Choose up to C{count} items uniformly and without replacement.
+
+    Uses Algorithm R so the input is consumed in a single pass while holding
+    only C{count} items in memory. The result is returned in random order.
+
+    @param rng: An object providing C{randrange} and C{shuffle}, such as a
+        seeded C{random.Random} instance.
+    """
+    chosen = []
+    if count <= 0:
+        return chosen
+
+    for seen, item in enumerate(iterable):
+        if seen < count:
+            chosen.append(item)
+        else:
+            idx = rng.randrange(0, seen + 1)
+            if idx < count:
+                chosen[idx] = item
+
+    rng.shuffle(chosen)
+    return chosen
+
+def keyed_sample(iterable, count, seed):
+    """Choose up to C{count} items uniformly and without replacement in a way
+    which depends only on C{seed} and the set of items, not their order.
+
+    Each item is given a pseudo-random sort key by hashing it with C{seed}
+    and the C{count} lowest keys are kept in a bounded heap. This makes the
+    result reproducible even when the input comes from a multithreaded walk.
+    """
+    seed = str(seed) + '\0'
+    return heapq.nsmallest(count, iterable,
+                           key=lambda x: hashlib.md5(seed + x).digest())
+
+class AliasTable(object):
+    """Vose's alias method for drawing indexes with probability proportional
+    to their weights: O(n) setup, then O(1) per draw.
+
+    @param weights: A sequence of positive numbers.
+    """
+    def __init__(self, weights):
+        count, total = len(weights), float(sum(weights))
+        if not count or total <= 0:
+            raise ValueError("Need at least one positive weight")
+
+        scaled = [x * count / total for x in weights]
+        self.prob, self.alias = [1.0] * count, list(xrange(count))
+        small = [i for i, x in enumerate(scaled) if x < 1]
+        large = [i for i, x in enumerate(scaled) if x >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less], self.alias[less] = scaled[less], more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Anything left over is within rounding error of 1 and keeps the
+        # initial probability of 1.0
+
+    def draw(self, rng=random):
+        """Return a random index, weighted as requested."""
+        idx = int(rng.random() * len(self.prob))
+        return idx if rng.random() < self.prob[idx] else self.alias[idx]
+
+class WeightedPool(object):
+    """The items with positive weights and an L{AliasTable} to draw them
+    by, for L{weighted_sample}.
+
+    Building one is O(n) in time and memory, so callers which sample the
+    same items repeatedly (eg. the daemon) should keep it around.
+
+    @param weights: One number per item. Items weighted C{0} are left out.
+    """
+    def __init__(self, items, weights):
+        self.items, self.weights = [], []
+        for item, weight in itertools.izip(items, weights):
+            if weight > 0:
+                self.items.append(item)
+                self.weights.append(weight)
+        self.table = AliasTable(self.weights) if self.items else None
+
+        # Per-item values which callers want to compute only once per pool
+        # (eg. L{history.path_id}), keyed by item
+        self.memo = {}
+
+    def __len__(self):
+        return len(self.items)
+
+def weighted_sample(pool, count, rng=random, group_of=None,
+                    max_per_group=None, skip=None, picked=()):
+    """Choose up to C{count} items from a L{WeightedPool} without
+    replacement, each with probability proportional to its weight.
+
+    Draws come from the pool's L{AliasTable} and repeats are rejected, so
+    the cost is proportional to C{count} rather than C{len(pool)} unless
+    almost everything eligible is wanted. In that case, the rest are chosen
+    by a single weighted-shuffle pass (Efraimidis-Spirakis) instead.
+
+    @param group_of: If provided with C{max_per_group}, a function mapping
+        an item to its group (eg. its album) for the quota.
+    @param max_per_group: The most items to choose from any one group.
+    @param skip: If provided, a function which returns C{True} for items
+        which mustn't be chosen (eg. ones played recently). It's called
+        for the items drawn, which means every remaining item if the
+        weighted-shuffle pass is needed, so callers should make repeated
+        calls for one item cheap. If fewer than C{count} items are
+        returned, it has been called for every item not in C{picked}.
+    @param picked: Items chosen already (eg. by an earlier call). They
+        won't be chosen again and count towards C{max_per_group}.
+    """
+    if count <= 0 or not pool:
+        return []
+    items, weights = pool.items, pool.weights
+
+    chosen, taken, skipped, groups = [], set(), set(), Counter()
+    picked = set(picked)
+    if max_per_group is not None:
+        groups.update(group_of(x) for x in picked)
+
+    def take(idx):
+        """Choose C{items[idx]} if it's new and its group isn't full"""
+        if idx in taken or idx in skipped:
+            return
+        if items[idx] in picked or skip and skip(items[idx]):
+            skipped.add(idx)
+            return
+        if max_per_group is not None:
+            group = group_of(items[idx])
+            if groups[group] >= max_per_group:
+                return
+            groups[group] += 1
+        taken.add(idx)
+        chosen.append(items[idx])
+
+    budget = count * REJECTION_BUDGET
+    while len(chosen) < count and budget:
+        take(pool.table.draw(rng))
+        budget -= 1
+
+    if len(chosen) < count:
+        keys = sorted(((rng.random() ** (1.0 / weight), idx)
+                       for idx, weight in enumerate(weights)
+                       if idx not in taken and idx not in skipped),
+                      reverse=True)
+        for _, idx in keys:
+            if len(chosen) >= count:
+                break
+            take(idx)
+    return chosen
+
+def parse_weight_args(weight_args):
+    """Parse C{--weight} arguments of the form C{DIR=WEIGHT} or
+    C{type:NAME=WEIGHT} into a list of C{(kind, key, weight)} tuples.
+
+    @raises KeyError: An unknown filetype category was given.
+    @raises ValueError: An argument was malformed.
+    """
+    results = []
+    for arg in weight_args:
+        spec, _, weight = arg.rpartition('=')
+        if not spec:
+            raise ValueError("Expected DIR=WEIGHT or type:NAME=WEIGHT: %s"
+                             % arg)
+        weight = float(weight)
+        if weight < 0:
+            raise ValueError("Weights can't be negative: %s" % arg)
+
+        if spec.startswith('type:'):
+            if spec[5:] not in FILETYPES:
+                raise KeyError(spec[5:])
+            results.append(('type', spec[5:], weight))
+        else:
+            results.append(('dir', os.path.abspath(spec), weight))
+    return results
+
+def get_weights(paths, weights=(), per_album=False):
+    """Return a weight for each of C{paths}.
+
+    @param weights: C{(kind, key, weight)} tuples from L{parse_weight_args}.
+        A file's weight is the product of the weight of its closest listed
+        ancestor directory and that of its filetype category.
+    @param per_album: Divide each file's weight by the number of files in
+        its directory so every album gets the same share.
+    """
+    dirs = sorted(((key.rstrip(os.sep) + os.sep, weight)
+                   for kind, key, weight in weights if kind == 'dir'),
+                  key=lambda x: len(x[0]), reverse=True)
+    exts = {}
+    for kind, key, weight in weights:
+        if kind == 'type':
+            for ext in FILETYPES[key]:
+                exts[ext.lower()] = exts.get(ext.lower(), 1.0) * weight
+    album_sizes = per_album and Counter(os.path.dirname(x) for x in paths)
+
+    dir_weights, results = {}, []
+    for path in paths:
+        parent = os.path.dirname(path)
+        weight = dir_weights.get(parent)
+        if weight is None:
+            weight = next((w for prefix, w in dirs
+                           if (parent + os.sep).startswith(prefix)), 1.0)
+            if album_sizes:
+                weight /= album_sizes[parent]
+            dir_weights[parent] = weight
+        if exts:
+            weight *= exts.get(os.path.splitext(path)[1].lower(), 1.0)
+        results.append(weight)
+    return results
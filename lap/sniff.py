@@ -0,0 +1,267 @@
+"""Content-based format detection for files with missing or misleading
+extensions
+
+Only the first L{HEADER_SIZE} bytes of each file are read and verdicts are
+cached by C{(device, inode, mtime, size)} so that repeated queries never
+re-read unchanged files.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import logging, os, sqlite3, string, threading
+from multiprocessing.pool import ThreadPool
+log = logging.getLogger(__name__)
+
+from .cache import get_cache_path
+from .filetypes import FILETYPES, MODULE_EXTS, OK_EXTS
+
+DEFAULT_CACHE_NAME = 'sniff.sqlite'
+
+# ProTracker stores its signature at offset 1080, so this is the minimum
+# needed to recognize the most common kind of extensionless module.
+HEADER_SIZE = 1084
+
+# Extensions shared with enough non-media formats that they can't be trusted
+AMBIGUOUS_EXTS = frozenset(['.m', '.raw'])
+
+# Amiga-style names like "mod.songname" put the type first
+MISNAMED_PREFIXES = tuple(x.lstrip('.') + '.' for x in MODULE_EXTS)
+
+KNOWN_EXTS = frozenset(x.lower() for exts in FILETYPES.values() for x in exts)
+
+# (category, [(offset, signature), ...]) in the order they should be tried
+MAGIC = [
+    ('waveform', [(0, 'RIFF'), (8, 'WAVE')]),
+    ('video', [(0, 'RIFF'), (8, 'AVI ')]),
+    ('midi', [(0, 'RIFF'), (8, 'RMID')]),
+    ('waveform', [(0, 'FORM'), (8, 'AIFF')]),
+    ('waveform', [(0, 'FORM'), (8, 'AIFC')]),
+    ('waveform', [(4, 'ftypM4A')]),
+    ('video', [(4, 'ftyp')]),
+    ('waveform', [(0, 'ID3')]),
+    ('waveform', [(0, 'fLaC')]),
+    ('waveform', [(0, 'OggS')]),
+    ('waveform', [(0, 'MAC ')]),
+    ('waveform', [(0, 'wvpk')]),
+    ('waveform', [(0, 'MPCK')]),
+    ('waveform', [(0, 'MP+')]),
+    ('waveform', [(0, 'TTA1')]),
+    ('waveform', [(0, 'ajkg')]),
+    ('waveform', [(0, '.snd')]),
+    ('waveform', [(0, 'Creative Voice File')]),
+    ('waveform', [(0, '\x30\x26\xb2\x75\x8e\x66\xcf\x11')]),  # ASF (WMA)
+    ('video', [(0, '\x1a\x45\xdf\xa3')]),  # Matroska/WebM
+    ('video', [(0, 'FLV')]),
+    ('video', [(0, '.RMF')]),
+    ('midi', [(0, 'MThd')]),
+    ('module', [(0, 'Extended Module: ')]),
+    ('module', [(0, 'IMPM')]),
+    ('module', [(44, 'SCRM')]),
+    ('module', [(20, '!Scream!')]),
+    ('module', [(1080, 'M.K.')]),
+    ('module', [(1080, 'M!K!')]),
+    ('module', [(1080, 'FLT4')]),
+    ('module', [(1080, '4CHN')]),
+    ('module', [(1080, '6CHN')]),
+    ('module', [(1080, '8CHN')]),
+    ('console', [(0, 'PSID')]),
+    ('console', [(0, 'RSID')]),
+    ('console', [(0, 'NESM\x1a')]),
+    ('console', [(0, 'NSFE')]),
+    ('console', [(0, 'GBS')]),
+    ('console', [(0, 'SNES-SPC700')]),
+    ('console', [(0, 'Vgm ')]),
+    ('console', [(0, 'ZXAYEMUL')]),
+    ('console', [(0, 'PSF')]),
+    ('console', [(0, 'GYMX')]),
+    ('console', [(0, 'HESM')]),
+    ('console', [(0, 'KSCC')]),
+    ('console', [(0, 'KSSX')]),
+    ('adlib', [(0, 'RAWADATA')]),
+    ('adlib', [(0, 'DBRAWOPL')]),
+    ('adlib', [(0, 'CTMF')]),
+]
+
+# Signatures which only one extension in their category is used for, so
+# blacklists (eg. --random's .sid and .mid) can apply to sniffed files too
+SIGNATURE_EXTS = {'PSID': '.sid', 'RSID': '.sid', 'RMID': '.rmi',
+                  'MThd': '.mid'}
+
+_TEXT_BYTES = string.printable
+
+def identify(header):
+    """Guess the L{FILETYPES} category of a file from its first bytes.
+
+    @returns: C{(category, ext)} where C{category} is C{None} if nothing
+        matched and C{ext} is the extension the format implies, if it's
+        one of L{SIGNATURE_EXTS}. Plain text is reported as C{'text'} so
+        that source code with a media-like extension (eg. C{.m}) can be
+        rejected.
+    """
+    for category, checks in MAGIC:
+        for offset, sig in checks:
+            if header[offset:offset + len(sig)] != sig:
+                break
+        else:
+            return category, SIGNATURE_EXTS.get(checks[-1][1])
+
+    # Bare MPEG audio frames (MP3 without ID3, ADTS AAC) start with a sync
+    if len(header) > 1 and header[0] == '\xff' and ord(header[1]) >= 0xe0:
+        return 'waveform', None
+
+    if header and not header.translate(None, _TEXT_BYTES):
+        return 'text', None
+    return None, None
+
+def sniff_file(path):
+    """Read the start of C{path} and return L{identify}'s verdict for it."""
+    try:
+        with open(path, 'rb') as fobj:
+            return identify(fobj.read(HEADER_SIZE))
+    except IOError, err:
+        log.debug("Could not sniff %s: %s", path, err)
+        return None, None
+
+def is_misnamed(name):
+    """Return C{True} if C{name} lacks a known extension but might still be
+    media. (ie. It has no extension or an Amiga-style type prefix)"""
+    if os.path.splitext(name)[1].lower() in KNOWN_EXTS:
+        return False
+    return '.' not in name or name.lower().startswith(MISNAMED_PREFIXES)
+
+class SniffCache(object):
+    """Persistent map from C{os.stat} results to L{identify} verdicts
+
+    SQLite connections can't be shared between threads and a
+    L{SniffFilter} may be run from a background thread (eg. by
+    L{ResultStream}), so each thread opens its own on first use.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or get_cache_path(DEFAULT_CACHE_NAME)
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """The calling thread's connection to the cache"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS sniffed ("
+                         "dev INTEGER, ino INTEGER, mtime REAL, "
+                         "size INTEGER, category TEXT, ext TEXT, "
+                         "PRIMARY KEY (dev, ino))")
+        return conn
+
+    @staticmethod
+    def _key(stat):
+        """Extract the cache key from an C{os.stat} result"""
+        return stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size
+
+    def get(self, stat):
+        """Return C{(found, verdict)} for a file's C{os.stat} result, where
+        C{verdict} is an L{identify} result."""
+        row = self.conn.execute(
+            "SELECT category, ext FROM sniffed WHERE dev = ? AND ino = ? "
+            "AND mtime = ? AND size = ?", self._key(stat)).fetchone()
+        return (row is not None), (row and tuple(row))
+
+    def put_many(self, items):
+        """Record C{(stat, verdict)} pairs."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sniffed VALUES (?, ?, ?, ?, ?, ?)",
+                [self._key(stat) + tuple(verdict) for stat, verdict in items])
+
+class SniffFilter(object):
+    """Verify questionable paths in a stream by content, in parallel.
+
+    Paths with a trustworthy extension pass straight through. Those with an
+    ambiguous extension or none at all are sniffed and only kept if their
+    content matches one of the wanted categories.
+    """
+    chunk_size = 256
+
+    def __init__(self, exts=OK_EXTS, jobs=4, cache=None, sniff_unknown=False,
+                 blacklist=None):
+        """
+        @param exts: The extensions whose categories are wanted.
+        @param sniff_unknown: Also sniff files with unrecognized extensions
+            rather than only those which look misnamed.
+        @param blacklist: If provided (as with C{--random}), extensions to
+            reject. Unless C{exts} is also given, every category with an
+            extension not in it is wanted.
+        """
+        self.blacklist = blacklist or frozenset()
+        if exts is None:
+            exts = KNOWN_EXTS.difference(blacklist) if blacklist else OK_EXTS
+        self.categories = set(name for name, cat_exts in FILETYPES.items()
+                              if exts.intersection(cat_exts))
+        self.jobs = jobs
+        self.cache = cache or SniffCache()
+        self.sniff_unknown = sniff_unknown
+
+    def needs_sniff(self, name):
+        """Return C{True} if C{name} can only be judged by its content."""
+        ext = os.path.splitext(name)[1].lower()
+        if ext in AMBIGUOUS_EXTS:
+            return True
+        elif ext in KNOWN_EXTS:
+            return False
+        return self.sniff_unknown or is_misnamed(name)
+
+    def _verdicts(self, paths, pool):
+        """Return C{{path: verdict}} for C{paths}, sniffing cache misses
+        with the threads in C{pool}."""
+        verdicts, misses = {}, []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                verdicts[path] = (None, None)
+                continue
+
+            found, verdict = self.cache.get(stat)
+            if found:
+                verdicts[path] = verdict
+            else:
+                misses.append((path, stat))
+
+        if misses:
+            results = pool.map(sniff_file, [x[0] for x in misses])
+            self.cache.put_many((stat, verdict) for (_, stat), verdict
+                                in zip(misses, results))
+            verdicts.update(zip([x[0] for x in misses], results))
+        return verdicts
+
+    def _filter_chunk(self, chunk, pool):
+        """Filter one chunk of paths, preserving order."""
+        questionable = [x for x in chunk
+                        if self.needs_sniff(os.path.basename(x))]
+        verdicts = questionable and self._verdicts(questionable, pool) or {}
+        return [x for x in chunk if x not in verdicts or
+                (verdicts[x][0] in self.categories and
+                 verdicts[x][1] not in self.blacklist)]
+
+    def filter(self, paths):
+        """Yield the members of C{paths} which pass verification.
+
+        Every chunk is sniffed by the same pool of C{self.jobs} threads,
+        which is shut down when the generator finishes or is closed.
+        """
+        pool, chunk = ThreadPool(self.jobs), []
+        try:
+            for path in paths:
+                chunk.append(path)
+                if len(chunk) >= self.chunk_size:
+                    for kept in self._filter_chunk(chunk, pool):
+                        yield kept
+                    chunk = []
+            for kept in self._filter_chunk(chunk, pool):
+                yield kept
+        finally:
+            pool.close()
+            pool.join()
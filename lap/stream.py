@@ -0,0 +1,139 @@
+"""Helpers for consuming search results while the search is still running"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import logging, subprocess, threading, time
+log = logging.getLogger(__name__)
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+class LocateProcess(object):
+    """Iterable over the output of a C{locate} command which can be
+    cancelled from another thread.
+
+    Lines are read one at a time rather than with Python 2's read-ahead
+    file iteration so that results are yielded as soon as C{locate} prints
+    them.
+    """
+    def __init__(self, cmd, keep=None):
+        """
+        @param keep: If provided, only yield results for which C{keep}
+            returns C{True}.
+        """
+        self.cmd = cmd
+        self.keep = keep
+        self.proc = None
+        self.cancelled = False
+
+    def __iter__(self):
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+        if self.cancelled:  # Lost the race with cancel()
+            self.cancel()
+
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                result = line.strip()
+                if self.keep is None or self.keep(result):
+                    yield result
+        finally:
+            self.proc.stdout.close()
+            self.proc.wait()
+
+    def cancel(self):
+        """Terminate C{locate} if it's still running."""
+        self.cancelled = True
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.terminate()
+            except OSError:  # Exited in the meantime
+                pass
+
+class ResultStream(object):
+    """Drain an iterable of results in a background thread, handing them
+    over in batches.
+
+    Results are batched so a consumer such as a UI only has to wake up a
+    few times per second, no matter how quickly they arrive.
+    """
+    batch_size = 1024
+    interval = 0.1
+
+    def __init__(self, source, pipeline=None):
+        """
+        @param source: An iterable of results. If it has a C{cancel()}
+            method, L{cancel} will call it to stop the search early.
+        @param pipeline: If provided, a function which is passed the
+            iterator over C{source} and returns a filtered iterator.
+        """
+        self.source = source
+        self.pipeline = pipeline
+        self.count = 0
+        self.done = False
+
+        self._batches = queue.Queue()
+        self._cancelled = threading.Event()
+
+    def start(self, on_ready=None):
+        """Begin searching in a daemon thread.
+
+        @param on_ready: Called with no arguments, from the search thread,
+            whenever a batch is waiting or the search has finished.
+        """
+        thread = threading.Thread(target=self._run, args=(on_ready,))
+        thread.daemon = True
+        thread.start()
+
+    def _flush(self, batch, on_ready):
+        """Queue up C{batch} and notify the consumer"""
+        self.count += len(batch)
+        self._batches.put(batch)
+        if on_ready:
+            on_ready()
+
+    def _run(self, on_ready):
+        """Body of the search thread"""
+        paths = iter(self.source)
+        if self.pipeline:
+            paths = self.pipeline(paths)
+
+        batch, deadline = [], time.time() + self.interval
+        try:
+            for path in paths:
+                if self._cancelled.is_set():
+                    break
+                batch.append(path)
+                if len(batch) >= self.batch_size or time.time() > deadline:
+                    self._flush(batch, on_ready)
+                    batch, deadline = [], time.time() + self.interval
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Search failed")
+        finally:
+            if batch:
+                self._flush(batch, None)
+            self.done = True
+            if on_ready:
+                on_ready()
+
+    def get_batches(self):
+        """Return every batch which has arrived since the last call, in
+        order, without blocking."""
+        batches = []
+        while True:
+            try:
+                batches.append(self._batches.get_nowait())
+            except queue.Empty:
+                return batches
+
+    def cancel(self):
+        """Stop searching as soon as possible."""
+        self._cancelled.set()
+        cancel = getattr(self.source, 'cancel', None)
+        if cancel:
+            cancel()
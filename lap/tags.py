@@ -0,0 +1,241 @@
+"""SQLite-backed index of tag metadata for C{field:value} queries
+
+Tags are read with U{mutagen<https://mutagen.readthedocs.io/>} (optional)
+in a pool of worker processes and stored as per-field postings lists: one
+row per C{(field, word, track)}, indexed on C{(field, word)}. A query like
+C{artist:beat year:1969} is then a few index range scans intersected in
+SQL, with no file I/O at all.
+
+Like L{MediaIndex}, updates only re-read files whose mtime has changed.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import logging, os, re, sqlite3
+log = logging.getLogger(__name__)
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None  # pylint: disable=invalid-name
+
+from .cache import get_cache_path
+from .filetypes import OK_EXTS, has_ext
+from .index import _is_under
+from .walk import iter_files
+
+DEFAULT_TAGS_NAME = 'tags.sqlite'
+
+# Queryable fields and the (easy) mutagen keys they're read from
+FIELDS = {
+    'album': ['album'],
+    'artist': ['artist', 'albumartist', 'performer'],
+    'genre': ['genre'],
+    'title': ['title'],
+    'year': ['date', 'originaldate'],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    field TEXT NOT NULL,
+    term TEXT NOT NULL,
+    track INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (field, term);
+CREATE INDEX IF NOT EXISTS postings_track ON postings (track);
+"""
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_YEAR_RE = re.compile(r'\b(\d{4})\b')
+
+def tokenize(text):
+    """Split C{text} into lowercase, UTF-8 encoded words."""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return [x.encode('utf-8') for x in _WORD_RE.findall(text.lower())]
+
+def split_query(args):
+    """Split command-line arguments into C{field:value} terms and ordinary
+    path keywords.
+
+    A leading backslash (eg. C{\\artist:foo}) makes something which would
+    be a term into a path keyword instead and is removed.
+
+    @returns: C{(terms, keywords)} where C{terms} is a list of
+        C{(field, value)} tuples.
+    """
+    terms, keywords = [], []
+    for arg in args:
+        escaped = arg.startswith('\\')
+        field, sep, value = arg[escaped:].partition(':')
+        if not (sep and value and field.lower() in FIELDS):
+            keywords.append(arg)
+        elif escaped:
+            keywords.append(arg[1:])
+        else:
+            terms.append((field.lower(), value))
+    return terms, keywords
+
+def read_tags(path):
+    """Return C{(path, mtime, {field: [word, ...]})} for one file.
+
+    C{mtime} is C{None} if the file has disappeared. This runs in
+    worker processes, so it must stay a picklable top-level function.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return path, None, None
+
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception, err:  # pylint: disable=broad-except
+        # mutagen raises a variety of errors for corrupt files. Record them
+        # as untagged so they aren't retried until they change.
+        log.debug("Could not read tags from %s: %s", path, err)
+        return path, mtime, {}
+
+    if audio is None or not audio.tags:
+        return path, mtime, {}
+
+    tags = {}
+    for field, keys in FIELDS.items():
+        words = set()
+        for key in keys:
+            try:
+                values = audio.tags[key]
+            except (KeyError, ValueError):
+                continue
+            for value in values:
+                if field == 'year':
+                    words.update(_YEAR_RE.findall(unicode(value)))
+                else:
+                    words.update(tokenize(unicode(value)))
+        if words:
+            tags[field] = sorted(words)
+    return path, mtime, tags
+
+class TagIndex(object):
+    """Persistent, incrementally-updated inverted index of tags."""
+
+    def __init__(self, db_path=None, exts=OK_EXTS):
+        self.db_path = db_path or get_cache_path(DEFAULT_TAGS_NAME)
+        self.exts = exts
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.text_factory = str  # Paths are bytestrings. Keep them so.
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
+
+    def is_empty(self):
+        """Return C{True} if nothing has been indexed yet."""
+        return self.conn.execute(
+            "SELECT 1 FROM tracks LIMIT 1").fetchone() is None
+
+    def _store(self, track_id, path, mtime, tags):
+        """Replace the recorded tags for one file."""
+        if track_id is None:
+            track_id = self.conn.execute(
+                "INSERT INTO tracks (path, mtime) VALUES (?, ?)",
+                (path, mtime)).lastrowid
+        else:
+            self.conn.execute("UPDATE tracks SET mtime = ? WHERE id = ?",
+                              (mtime, track_id))
+            self.conn.execute("DELETE FROM postings WHERE track = ?",
+                              (track_id,))
+        self.conn.executemany(
+            "INSERT INTO postings (field, term, track) VALUES (?, ?, ?)",
+            [(field, word, track_id) for field, words in tags.items()
+             for word in words])
+
+    def update(self, roots, jobs=None):
+        """Bring the index up to date for the media files under C{roots}.
+
+        Files whose mtime hasn't changed since they were last read are
+        skipped. The rest are read by C{jobs} processes. (default: one per
+        CPU)
+
+        @raises ImportError: mutagen isn't installed.
+        @type roots: C{list} of C{basestring}
+        """
+        if mutagen is None:
+            raise ImportError("Reading tags requires mutagen")
+
+        roots = [os.path.abspath(x) for x in roots]
+        known = dict((path, (track_id, mtime)) for track_id, path, mtime in
+                     self.conn.execute("SELECT id, path, mtime FROM tracks")
+                     if any(_is_under(path, x) for x in roots))
+
+        seen, changed = set(), []
+        for root in roots:
+            for path in iter_files(root, lambda x: has_ext(x, self.exts)):
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                seen.add(path)
+                if known.get(path, (None, None))[1] != mtime:
+                    changed.append(path)
+        stale = [(known[x][0],) for x in known if x not in seen]
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM postings WHERE track = ?",
+                                  stale)
+            self.conn.executemany("DELETE FROM tracks WHERE id = ?", stale)
+
+            if jobs == 1 or len(changed) < 2:
+                results = (read_tags(x) for x in changed)
+                pool = None
+            else:
+                from multiprocessing import Pool
+                pool = Pool(jobs)
+                results = pool.imap_unordered(read_tags, changed, 16)
+
+            try:
+                for path, mtime, tags in results:
+                    if mtime is not None:
+                        self._store(known.get(path, (None,))[0], path,
+                                    mtime, tags)
+            finally:
+                if pool:
+                    pool.terminate()
+                    pool.join()
+
+        log.info("Tag index updated: %d files read, %d removed",
+                 len(changed), len(stale))
+
+    def search(self, terms):
+        """Return the paths of files matching every C{(field, value)} in
+        C{terms}.
+
+        Each word of C{value} must be a prefix of some word in the field,
+        case-insensitively, so C{artist:beat} matches "The Beatles".
+        """
+        clauses, params = [], []
+        for field, value in terms:
+            words = tokenize(value)
+            if not words:
+                return []
+            for word in words:
+                # UTF-8 never contains \xff, so this bounds every string
+                # which starts with `word`
+                clauses.append("SELECT track FROM postings WHERE field = ? "
+                               "AND term >= ? AND term < ?")
+                params.extend([field, word, word + '\xff'])
+
+        if not clauses:
+            return []
+        return [row[0] for row in self.conn.execute(
+            "SELECT path FROM tracks WHERE id IN (%s)" %
+            " INTERSECT ".join(clauses), params)]
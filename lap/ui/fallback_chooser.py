@@ -5,7 +5,7 @@ from __future__ import print_function, absolute_import
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2 or later"
 
-import os
+import os, struct, sys
 
 # Use readline if available but don't depend on it
 try:
@@ -16,6 +16,8 @@ try:
 except ImportError:
     pass
 
+DEFAULT_ROWS = 24
+
 def parse_choice(in_str):
     """Parse a string containing one or more integers or Python ranges
     separated by commas.
@@ -40,14 +42,112 @@ def parse_choice(in_str):
                     print("Not an integer or range: %s" % x)
         return choices
 
-# TODO: Document and, if necessary, refactor
+def get_page_size(stream=sys.stdout):
+    """Return how many results fit on one screen of C{stream}'s terminal,
+    leaving room for the status line and prompt.
+
+    Returns C{None} (no paging) if C{stream} isn't a terminal.
+    """
+    if not stream.isatty():
+        return None
+
+    rows = 0
+    try:
+        import fcntl, termios
+        rows = struct.unpack('hh', fcntl.ioctl(stream.fileno(),
+                             termios.TIOCGWINSZ, '\0' * 4))[0]
+    except (ImportError, IOError, struct.error):
+        pass
+
+    if not rows:
+        try:
+            rows = int(os.environ.get('LINES', ''))
+        except ValueError:
+            rows = DEFAULT_ROWS
+    return max(rows - 2, 1)
+
+class Pager(object):
+    """Tracks which slice of C{results} is on screen and draws it.
+
+    Lines are only formatted for the page being shown, so the cost of
+    drawing doesn't depend on how many results there are.
+    """
+    def __init__(self, results, strip_path, page_size=None):
+        self.results = results
+        self.strip_path = strip_path
+        self.page_size = page_size or len(results) or 1
+        self.start = 0
+        self.last_search = None
+
+    def draw(self):
+        """Print the current page and, if there is more than one, a
+        status line describing the paging commands."""
+        end = min(self.start + self.page_size, len(self.results))
+        for pos in xrange(self.start, end):
+            val = self.results[pos]
+            val = self.strip_path and os.path.basename(val) or val
+            print("%3d) %s" % (pos + 1, val))
+
+        if len(self.results) > self.page_size:
+            print("-- %d-%d of %d -- (n)ext, (p)revious, g <num>, /<text>"
+                  % (self.start + 1, end, len(self.results)))
+
+    def go(self, start):
+        """Move so that C{start} is the first result shown, if valid."""
+        if 0 <= start < len(self.results):
+            self.start = start
+
+    def search(self, text):
+        """Move to the next result containing C{text}, wrapping around.
+
+        @returns: C{False} if nothing matched.
+        """
+        text = (text or self.last_search or '').lower()
+        self.last_search = text
+        count = len(self.results)
+        for offset in xrange(1, count + 1):
+            pos = (self.start + offset) % count
+            if text in self.results[pos].lower():
+                self.start = pos
+                return True
+        return False
+
+    def command(self, in_str):
+        """Handle C{in_str} if it's a paging command.
+
+        @returns: C{True} if C{in_str} was a command rather than a choice.
+        """
+        cmd = in_str.strip()
+        if cmd == 'n':
+            self.go(self.start + self.page_size)
+        elif cmd == 'p':
+            self.go(max(self.start - self.page_size, 0))
+        elif cmd.startswith('g ') and cmd[2:].strip().isdigit():
+            self.go(int(cmd[2:]) - 1)
+        elif cmd.startswith('/'):
+            if not self.search(cmd[1:]):
+                print("Not found: %s" % self.last_search)
+                return True
+        else:
+            return False
+        self.draw()
+        return True
+
 def choose(results, strip_path, enqueue):
-    # Draw the menu
-    for pos, val in enumerate(results):
-        val = strip_path and os.path.basename(val) or val
-        print("%3d) %s" % (pos + 1, val))
+    """Let the user pick from C{results} by index at a plain TTY prompt.
+
+    Long lists are shown a page at a time. Indices always refer to the
+    position in the full list, whichever page they were chosen from.
+
+    @returns: C{(chosen_results, enqueue)}
+    """
+    pager = Pager(results, strip_path, get_page_size())
+    pager.draw()
 
-    choices = raw_input("Choice(s) (Ctrl+C to cancel): ")
+    while True:
+        choices = raw_input("Choice(s) (Ctrl+C to cancel): ")
+        if not pager.command(choices):
+            break
 
     if 'q' in choices.lower():
         enqueue = True
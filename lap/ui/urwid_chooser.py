@@ -5,12 +5,15 @@ from __future__ import print_function, absolute_import
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2 or later"
 
-import logging
+import logging, os
+from collections import OrderedDict
 log = logging.getLogger(__name__)
 
 import urwid
 from urwid import AttrMap
 
+from ..query import IncrementalFilter
+
 CURSOR_MAX_UP = 'cursor max up'
 CURSOR_MAX_DOWN = 'cursor max down'
 
@@ -19,16 +22,29 @@ urwid.command_map['end'] = CURSOR_MAX_DOWN
 
 class BetterListBox(urwid.ListBox):
     """C{urwid.ListBox} subclass which implements more GUI-like behaviours."""
+    def __init__(self, body):
+        super(BetterListBox, self).__init__(body)
+
+        # Walkers which emit 'modified' for focus changes too can name a
+        # signal which is only emitted when their contents change.
+        self._limits = {}
+        urwid.connect_signal(body, getattr(body, 'contents_signal',
+                                           'modified'), self._limits.clear)
+
     def _find_limit(self, reverse=False):
         """Find the first/last focusable widget in the list.
 
-        @todo: Use the modified signal on the list walker to cache this
-               for proper performance on long lists.
+        The result is cached until the list walker's contents change.
         """
-        # pylint: disable=maybe-no-member
-        for x in self.body.positions(reverse=reverse):
-            if self.body[x].selectable():
-                return x
+        if reverse not in self._limits:
+            # pylint: disable=maybe-no-member
+            for x in self.body.positions(reverse=reverse):
+                if self.body[x].selectable():
+                    self._limits[reverse] = x
+                    break
+            else:
+                return None
+        return self._limits[reverse]
 
     def keypress(self, size, key):
         """@todo: Figure out how to get browser-like behaviour where this
@@ -37,7 +53,9 @@ class BetterListBox(urwid.ListBox):
         cmd = self._command_map[key]
         if cmd in [CURSOR_MAX_UP, CURSOR_MAX_DOWN]:
             key = None
-            self.focus_position = self._find_limit(cmd == CURSOR_MAX_DOWN)
+            limit = self._find_limit(cmd == CURSOR_MAX_DOWN)
+            if limit is not None:
+                self.focus_position = limit
 
         return super(BetterListBox, self).keypress(size, key)
 
@@ -46,12 +64,13 @@ class BetterListBox(urwid.ListBox):
         """@todo: Make the scrolling less jumpy and figure out how to do
                   it without altering widget focus.
         """
-        if urwid.util.is_mouse_press(event):
-            if button == 4:
-                limit = self._find_limit(False)
+        if urwid.util.is_mouse_press(event) and button in (4, 5):
+            limit = self._find_limit(button == 5)
+            if limit is None:
+                pass  # Nothing selectable (eg. everything filtered out)
+            elif button == 4:
                 self.focus_position = max(self.focus_position - 1, limit)
-            elif button == 5:
-                limit = self._find_limit(True)
+            else:
                 self.focus_position = min(self.focus_position + 1, limit)
         return super(BetterListBox, self).mouse_event(
             size, event, button, col, row, focus)
@@ -65,27 +84,304 @@ class MyCheckBox(urwid.CheckBox):
         """@todo: Submit as patch"""
         return 4 + len(self.get_label()), 1
 
+class ChoiceWalker(urwid.ListWalker):
+    """Lazy list walker presenting C{choices} as a column of checkboxes
+    between two blank dividers.
+
+    Row widgets are only built for positions urwid actually asks for and,
+    once C{cache_size} of them exist, the least recently used one is
+    relabelled and reused, so build time and memory depend on terminal
+    height rather than the number of choices. Selection state lives in a
+    C{bytearray} instead of the widgets.
+
+    Only the choices listed in C{view} are shown. Position C{0} and
+    C{len(view) + 1} are the dividers and position C{n + 1} is
+    C{choices[view[n]]}. Selection is always tracked by index into
+    C{choices} so it survives changes to the view.
+    """
+    signals = ['modified', 'contents_modified']
+    contents_signal = 'contents_modified'
+    cache_size = 256
+
+    def __init__(self, choices, on_toggle):
+        """
+        @param on_toggle: Called as C{on_toggle(cbox, new_state, idx)} when
+            the user changes a row's state.
+        """
+        self.choices = choices
+        self.selected = bytearray(len(choices))
+        self.on_toggle = on_toggle
+        self.view = xrange(len(choices))
+        self.focus = 1 if choices else 0
+
+        self._divider = urwid.Divider()
+        self._rows = OrderedDict()
+        self._spare = []
+
+    def __len__(self):
+        return len(self.view) + 2
+
+    def __getitem__(self, position):
+        widget = self._get(position)
+        if widget is None:
+            raise IndexError(position)
+        return widget
+
+    def positions(self, reverse=False):
+        """Iterate over every valid position, as C{urwid.ListWalker} does"""
+        if reverse:
+            return xrange(len(self) - 1, -1, -1)
+        return xrange(len(self))
+
+    def _contents_modified(self):
+        """Notify listeners that the list itself has changed"""
+        urwid.emit_signal(self, self.contents_signal)
+        self._modified()
+
+    def set_view(self, indices):
+        """Show only C{choices[idx] for idx in indices}, or everything if
+        C{indices} is C{None}."""
+        if indices is None:
+            indices = xrange(len(self.choices))
+        self.view = indices
+        self.focus = 1 if indices else 0
+
+        # Every cached row now belongs to the wrong position
+        self._spare.extend(self._rows.values())
+        self._rows.clear()
+        self._contents_modified()
+
+    def grow(self, indices):
+        """Catch up after items were appended to C{choices}, keeping focus
+        and cached rows since existing positions are unaffected.
+
+        @param indices: The new view, as for L{set_view}.
+        """
+        self.selected.extend(bytearray(len(self.choices) - len(self.selected)))
+        if indices is None:
+            indices = xrange(len(self.choices))
+        self.view = indices
+        if not self.focus and indices:
+            self.focus = 1
+        self._contents_modified()
+
+    def refresh(self):
+        """Update the cached rows after C{selected} was changed directly."""
+        for row in self._rows.values():
+            cbox = row.original_widget.original_widget
+            cbox.set_state(bool(self.selected[cbox.choice_idx]),
+                           do_callback=False)
+        self._modified()
+
+    def _toggled(self, cbox, new_state):
+        """Record a checkbox state change and pass it on"""
+        self.selected[cbox.choice_idx] = new_state
+        self.on_toggle(cbox, new_state, cbox.choice_idx)
+
+    def _make_row(self):
+        """Build a fresh, unlabelled row widget"""
+        cbox = MyCheckBox(u'')
+        urwid.connect_signal(cbox, 'change', self._toggled)
+        return AttrMap(urwid.Padding(cbox, left=2, right=2), 'row',
+                       focus_map='selected')
+
+    def _get(self, position):
+        """Return the widget for C{position}, building or recycling one if
+        necessary, or C{None} if C{position} is out of range."""
+        if position in (0, len(self.view) + 1):
+            return self._divider
+        elif not 0 < position <= len(self.view):
+            return None
+
+        row = self._rows.pop(position, None)
+        if row is None:
+            if self._spare:
+                row = self._spare.pop()
+            elif len(self._rows) >= self.cache_size:
+                row = self._rows.popitem(last=False)[1]
+            else:
+                row = self._make_row()
+
+            idx = self.view[position - 1]
+            cbox = row.original_widget.original_widget
+            cbox.choice_idx = idx
+            cbox.set_label(self.choices[idx])
+            cbox.set_state(bool(self.selected[idx]), do_callback=False)
+            row.set_attr_map({None: 'row_zebra' if position % 2 else 'row'})
+
+        self._rows[position] = row
+        return row
+
+    def get_focus(self):
+        return self._get(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        widget = self._get(position + 1)
+        return widget, (None if widget is None else position + 1)
+
+    def get_prev(self, position):
+        if position <= 0:
+            return None, None
+        return self._get(position - 1), position - 1
+
 # pylint: disable=too-many-public-methods
 class SetEdit(urwid.Edit):
+    """Editable summary of a L{ChoiceWalker}'s selection.
+
+    The walker's C{selected} bitmap answers "is this entry picked?" while
+    C{self.picks} holds the same entries as C{(first, last)} runs in the
+    order they were picked, since that's the order they'll be played in.
+    The text shows the runs (eg. C{0:9 12}) so even "select all" stays
+    short. Anything the user types (indices, C{10:200} ranges, C{q}) is
+    folded back in by L{sync} before each change and when the chooser exits.
+    """
+    def __init__(self, walker, *args, **kwargs):
+        super(SetEdit, self).__init__(*args, **kwargs)
+        self.walker = walker
+        self.picks = []
+        self.extras = []
+        self._rendered = None
+
+    @staticmethod
+    def _runs(bitmap, start=0, end=None, value=b'\x01'):
+        """Yield C{(first, last)} for each run of C{value} entries between
+        C{start} and C{end}"""
+        other = b'\x00' if value == b'\x01' else b'\x01'
+        end = len(bitmap) if end is None else end
+        start = bitmap.find(value, start, end)
+        while start != -1:
+            stop = bitmap.find(other, start, end)
+            if stop == -1:
+                stop = end
+            yield start, stop - 1
+            start = bitmap.find(value, stop, end)
+
+    def _append(self, first, last):
+        """Add a run to the end of C{self.picks}, merging if contiguous"""
+        if self.picks and self.picks[-1][1] == first - 1:
+            first = self.picks.pop()[0]
+        self.picks.append((first, last))
+
+    def sync(self):
+        """Replace the selection with what the text describes if the user
+        has edited it since it was last rendered.
+
+        Picks keep the order they were typed in and entries typed twice
+        count once. Tokens which aren't valid indices or ranges (such as
+        C{q}) are kept in C{self.extras} so they survive re-rendering.
+
+        @returns: C{True} if the text was re-parsed.
+        """
+        text = self.get_edit_text()
+        if text == self._rendered:
+            return False
+
+        bitmap, count = self.walker.selected, len(self.walker.selected)
+        bitmap[:] = bytearray(count)
+        self.picks, self.extras = [], []
+        for token in text.replace(',', ' ').split():
+            try:
+                first, last = [int(x) for x in token.split(':', 1)]
+            except ValueError:
+                try:
+                    first = last = int(token)
+                except ValueError:
+                    first = last = None
+
+            if first is None or not 0 <= first <= last < count:
+                self.extras.append(token)
+                continue
+            for run in list(self._runs(bitmap, first, last + 1, b'\x00')):
+                bitmap[run[0]:run[1] + 1] = b'\x01' * (run[1] + 1 - run[0])
+                self._append(*run)
+
+        self._rendered = text
+        return True
+
+    def render_selection(self):
+        """Regenerate the text from C{self.picks}."""
+        tokens = [str(a) if a == b else '%d:%d' % (a, b)
+                  for a, b in self.picks]
+        self._rendered = ' '.join(tokens + self.extras)
+        self.set_edit_text(self._rendered)
+        self.set_edit_pos(len(self._rendered))
+
     def get_results(self):
-        return self.get_edit_text().strip().split()
+        """Return C{(indices, extras)} for the current selection, with
+        C{indices} in the order they were picked."""
+        self.sync()
+        indices = [idx for first, last in self.picks
+                   for idx in xrange(first, last + 1)]
+        return indices, self.extras
 
     def set_idx(self, idx, new_state):
-        selected = self.get_results()
+        """Update the selection after a single entry was (de)selected.
 
-        idx = str(idx)
-        if new_state and idx not in selected:
-            selected.append(idx)
-        elif not new_state:
-            while idx in selected:
-                selected.remove(idx)
+        Only the run containing C{idx} is touched, so toggling stays cheap
+        however much is selected.
+        """
+        if self.sync() and bool(self.walker.selected[idx]) == new_state:
+            pass  # The edited text already agrees
+        elif new_state:
+            self.walker.selected[idx] = 1
+            self._append(idx, idx)
+        else:
+            self.walker.selected[idx] = 0
+            for pos, (first, last) in enumerate(self.picks):
+                if first <= idx <= last:
+                    self.picks[pos:pos + 1] = [(a, b) for a, b in
+                        ((first, idx - 1), (idx + 1, last)) if a <= b]
+                    break
+        self.render_selection()
+
+    def bulk(self, operation):
+        """Apply C{'all'}, C{'none'} or C{'invert'} to the whole selection.
+
+        Newly-selected entries are picked after the existing ones, in
+        ascending order.
+        """
+        self.sync()
+        bitmap = self.walker.selected
+        unselected = list(self._runs(bitmap, value=b'\x00'))
+        if operation == 'all':
+            for run in unselected:
+                self._append(*run)
+            bitmap[:] = b'\x01' * len(bitmap)
+        elif operation == 'none':
+            self.picks = []
+            bitmap[:] = bytearray(len(bitmap))
+        elif operation == 'invert':
+            self.picks = unselected
+            bitmap[:] = bitmap.translate(b'\x01\x00' + b'\x00' * 254)
+        self.render_selection()
+        self.walker.refresh()
+
+class FilterEdit(urwid.Edit):
+    """C{urwid.Edit} which calls C{on_done} rather than passing Enter and
+    Esc up to the chooser, so they can't accidentally confirm it."""
+    on_done = None
 
-        self.set_edit_text(' '.join(selected))
+    def keypress(self, size, key):
+        if key in ('enter', 'esc'):
+            if self.on_done:
+                self.on_done()
+            return None
+        return super(FilterEdit, self).keypress(size, key)
 
 class UrwidChooser(object):
     """
+    Keys: Space toggles, Enter selects and confirms, Esc confirms, Q toggles
+    queueing, Meta+A/Meta+N/Meta+I select all/none/the inverse, and /
+    filters the list as you type. (Enter or Esc returns to the list)
+
+    If given a L{ResultStream}, choices are appended in the order they
+    arrive and can be chosen before the search has finished.
+
     @todo: Implement Tab-based widget focus cycling.
-    @todo: Implement find-as-you-type filtering.
     @todo: Other enhancements to consider:
        - https://excess.org/hg/urwid-contrib/file/
        - http://excess.org/urwid/wiki/ApplicationList
@@ -103,37 +399,41 @@ class UrwidChooser(object):
         #      so the last parameter is set to 'g89' for 256-color terminals.
     ]
     success = False
+    stream = None
+
+    bulk_keys = {'meta a': 'all', 'meta n': 'none', 'meta i': 'invert'}
 
     def __init__(self, title, choices):
         """@todo: Implement Home/End support for urwid.Edit"""
         self.choices = choices
         self.w_exec = urwid.Edit(wrap='clip')
-        self.w_selected = SetEdit()
+        self.w_walker = ChoiceWalker(choices, self.item_toggled)
+        self.w_selected = SetEdit(self.w_walker, wrap='clip')
         self.w_queue = MyCheckBox([('heading_ul', u'Q'), ('heading', u'ueue')])
-        self.w_frame = self._menu(title, choices)
+        self.w_count = urwid.Text(u'', align='right')
+        self.w_filter = FilterEdit(wrap='clip')
+        self.w_filter.on_done = self.focus_list
+        self.filter = IncrementalFilter(choices)
+        urwid.connect_signal(self.w_filter, 'change', self.filter_changed)
 
         # TODO: Why is right=1 required to prevent layout glitches?
-        self.main = urwid.Padding(self._menu(title, choices), left=1, right=1)
-
-    def _menu(self, title, choices):
-        head = AttrMap(urwid.Pile([
+        self.main = urwid.Padding(self._menu(title), left=1, right=1)
+
+    def _menu(self, title):
+        self.w_head_cols = urwid.Columns([
+            AttrMap(urwid.Text(title), 'heading'),
+            ('pack', urwid.Text('Filter:')),
+            (20, AttrMap(self.w_filter, 'row')),
+            ('pack', self.w_count),
+            ('pack', urwid.Text('Exec:')),
+            (20, AttrMap(self.w_exec, 'row')),
+        ], dividechars=1)
+        self.w_head_pile = urwid.Pile([
             urwid.Divider(),
-            urwid.Padding(urwid.Columns([
-                AttrMap(urwid.Text(title), 'heading'),
-                ('pack', urwid.Text('Exec:')),
-                (20, AttrMap(self.w_exec, 'row')),
-            ], dividechars=1), left=2, right=2),
+            urwid.Padding(self.w_head_cols, left=2, right=2),
             AttrMap(urwid.Divider(u'\N{LOWER ONE QUARTER BLOCK}'), 'line'),
-        ]), 'heading')
-
-        body = [urwid.Divider()]
-        for pos, path in enumerate(choices):
-            cbox = MyCheckBox(path)
-            urwid.connect_signal(cbox, 'change', self.item_toggled, pos)
-            body.append(AttrMap(urwid.Padding(cbox, left=2, right=2),
-                                'row' if pos % 2 else 'row_zebra',
-                                focus_map='selected'))
-        body += [urwid.Divider()]
+        ])
+        head = AttrMap(self.w_head_pile, 'heading')
 
         foot = AttrMap(urwid.Pile([
             AttrMap(urwid.Divider(u'\N{UPPER ONE EIGHTH BLOCK}'), 'line'),
@@ -145,16 +445,60 @@ class UrwidChooser(object):
             urwid.Divider(),
         ]), 'heading')
 
-        self.w_list = BetterListBox(urwid.SimpleFocusListWalker(body))
-        return urwid.Frame(AttrMap(self.w_list, 'row'),
-                           header=head, footer=foot)
+        self.w_list = BetterListBox(self.w_walker)
+        self.w_frame = urwid.Frame(AttrMap(self.w_list, 'row'),
+                                   header=head, footer=foot)
+        self.update_count()
+        return self.w_frame
 
     def item_toggled(self, cbox, new_state, idx):  # pylint: disable=W0613
         self.w_selected.set_idx(idx, new_state)
 
-    def run(self, queue, exec_cmd=''):
-
-        self.w_selected.set_edit_text('')
+    def update_count(self):
+        """Show how many of the choices are currently visible"""
+        shown, total = len(self.w_walker.view), len(self.choices)
+        text = u'%d/%d' % (shown, total) if shown != total else u'%d' % total
+        if self.stream and not self.stream.done:
+            text += u'\N{HORIZONTAL ELLIPSIS}'
+        self.w_count.set_text(text)
+
+    def add_choices(self, items):
+        """Append C{items} to the list, re-applying any active filter"""
+        start = len(self.choices)
+        self.choices.extend(items)
+        self.filter.extend(start)
+        self.w_walker.grow(self.filter.update(self.w_filter.get_edit_text()))
+
+    def stream_ready(self, data):  # pylint: disable=unused-argument
+        """Pick up whatever the search thread has found so far"""
+        done = self.stream.done  # Checked first so no batch can be missed
+        for batch in self.stream.get_batches():
+            self.add_choices(batch)
+        self.update_count()
+        return not done
+
+    def filter_changed(self, widget, text):  # pylint: disable=W0613
+        """Narrow the list to the choices containing C{text}"""
+        self.w_walker.set_view(self.filter.update(text))
+        self.update_count()
+
+    def focus_filter(self):
+        """Move the cursor into the filter field"""
+        self.filter.prepare()
+        self.w_frame.focus_position = 'header'
+        self.w_head_pile.focus_position = 1
+        self.w_head_cols.focus_position = 2
+
+    def focus_list(self):
+        """Move the cursor back to the list of choices"""
+        self.w_frame.focus_position = 'body'
+
+    def run(self, queue, exec_cmd='', stream=None):
+        """
+        @param stream: If provided, a L{ResultStream} which hasn't been
+            started yet. It will be fed into the list in the background.
+        """
+        self.w_selected.render_selection()
         self.w_exec.set_edit_text(exec_cmd)
         self.w_queue.set_state(queue)
 
@@ -163,28 +507,51 @@ class UrwidChooser(object):
         loop.screen.set_terminal_properties(256)
         # self.screen.reset_default_terminal_palette()
 
-        loop.run()
-
-        _ids = self.w_selected.get_results()
-        while 'q' in _ids:
-            self.w_queue.set_state(True)
-            _ids.remove('q')
-
-        results = []
-        for idx in _ids:
-            try:
-                results.append(self.choices[int(idx)])
-            except (ValueError, IndexError):
-                log.warn("Invalid index: %s of %s", idx, len(self.choices))
+        if stream:
+            self.stream = stream
+            self.update_count()
+            pipe_fd = loop.watch_pipe(self.stream_ready)
+
+            def notify():
+                """Wake up the main loop from the search thread"""
+                try:
+                    os.write(pipe_fd, b'.')
+                except OSError:  # The chooser has already exited
+                    pass
+                if stream.done:  # Last call. Safe to close our end now.
+                    os.close(pipe_fd)
+            stream.start(notify)
+
+        try:
+            loop.run()
+        finally:
+            if stream:
+                stream.cancel()
+                loop.remove_watch_pipe(pipe_fd)
+
+        indices, extras = self.w_selected.get_results()
+        for token in extras:
+            if token == 'q':
+                self.w_queue.set_state(True)
+            else:
+                log.warn("Invalid index: %s of %s", token, len(self.choices))
+
+        results = [self.choices[idx] for idx in indices]
         return results, self.w_queue.get_state(), self.w_exec.get_edit_text()
 
     def unhandled_key(self, key):
         if key == 'esc':
             raise urwid.ExitMainLoop()
         elif key == 'enter':
-            self.w_list.focus.original_widget.original_widget.set_state(True)
+            if self.w_walker.view:
+                row = self.w_list.focus
+                row.original_widget.original_widget.set_state(True)
             raise urwid.ExitMainLoop()
+        elif key == '/':
+            self.focus_filter()
         elif key in ['q', 'meta q']:
             self.w_queue.toggle_state()
+        elif key in self.bulk_keys:
+            self.w_selected.bulk(self.bulk_keys[key])
         # else:
         #     self.w_selected.set_caption(str(key) + ': ')
@@ -0,0 +1,171 @@
+"""Concurrent checks that paths still exist and are readable
+
+Results can come from a stale C{locate} database or a network mount which
+has stopped responding, so they're checked before being handed to a player
+or command. Paths are grouped by mount point and every mount gets its own
+worker threads, so one hung mount can only time out its own paths.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import logging, os, re, threading, time
+log = logging.getLogger(__name__)
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+MOUNTS_FILE = '/proc/mounts'
+
+DEFAULT_JOBS = 4        # Worker threads per mount
+DEFAULT_TIMEOUT = 5.0   # Seconds before a mount is considered hung
+DEFAULT_CHUNK_SIZE = 256
+
+def _unescape_mount(field):
+    """Decode the octal escapes (eg. C{\\040}) used in C{/proc/mounts}"""
+    return re.sub(r'\\([0-7]{3})', lambda x: chr(int(x.group(1), 8)), field)
+
+def read_mounts(path=MOUNTS_FILE):
+    """Return the set of mount points listed in C{path}.
+
+    Falls back to just C{/} if the list can't be read.
+    """
+    mounts = set(['/'])
+    try:
+        with open(path) as fobj:
+            for line in fobj:
+                fields = line.split()
+                if len(fields) > 1:
+                    mounts.add(_unescape_mount(fields[1]))
+    except IOError, err:
+        log.debug("Could not read %s: %s", path, err)
+    return mounts
+
+def group_by_mount(paths, mounts):
+    """Return C{{mount_point: [path, ...]}}, preserving order within each
+    group."""
+    groups, cache = {}, {}
+    for path in paths:
+        parent = os.path.dirname(path)
+        mount = cache.get(parent)
+        if mount is None:
+            mount = parent
+            while mount not in mounts and mount not in ('/', ''):
+                mount = os.path.dirname(mount)
+            mount = cache[parent] = mount if mount in mounts else '/'
+        groups.setdefault(mount, []).append(path)
+    return groups
+
+def check_path(path):
+    """Return C{None} if C{path} can be played or a reason why not."""
+    try:
+        os.stat(path)
+    except OSError, err:
+        return err.strerror.lower()
+    if not os.access(path, os.R_OK):
+        return "not readable"
+    return None
+
+def _worker(pending, results):
+    """Check paths from C{pending} until it's empty"""
+    while True:
+        try:
+            path = pending.get_nowait()
+        except queue.Empty:
+            return
+        results.put((path, check_path(path)))
+
+def validate_paths(paths, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT,
+                   mounts=None, hung=None):
+    """Check C{paths} concurrently.
+
+    Every mount is given up to C{timeout} seconds, all at the same time.
+    Threads stuck on a hung mount are daemonic and abandoned rather than
+    waited for.
+
+    @param jobs: The number of threads to use per mount.
+    @param mounts: The mount points to group by. (default: L{read_mounts})
+    @param hung: If provided, a C{set} of mount points which have already
+        timed out. Their paths are failed without being checked and any
+        mount which times out this time is added to it.
+    @returns: C{(valid, problems)} where C{valid} is the usable subset of
+        C{paths}, in order, and C{problems} is a list of C{(path, reason)}.
+    """
+    paths = list(paths)
+    if not paths:
+        return [], []
+
+    hung = set() if hung is None else hung
+    results = queue.Queue()
+    groups = group_by_mount(paths, read_mounts() if mounts is None
+                            else mounts)
+    for mount, mount_paths in groups.items():
+        if mount in hung:
+            continue
+
+        pending = queue.Queue()
+        for path in mount_paths:
+            pending.put(path)
+        for _ in range(min(jobs, len(mount_paths))):
+            thread = threading.Thread(target=_worker,
+                                      args=(pending, results))
+            thread.daemon = True
+            thread.start()
+
+    wanted = len(set(x for mount, mount_paths in groups.items()
+                     if mount not in hung for x in mount_paths))
+    verdicts = {}
+    deadline = time.time() + timeout
+    while len(verdicts) < wanted:
+        try:
+            path, verdict = results.get(
+                timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        verdicts[path] = verdict
+
+    for mount, mount_paths in groups.items():
+        if mount not in hung and any(x not in verdicts for x in mount_paths):
+            log.warning("Giving up on %s after %ss", mount, timeout)
+            hung.add(mount)
+
+    valid, problems = [], []
+    for path in paths:
+        if path not in verdicts:
+            problems.append((path, "mount not responding"))
+        elif verdicts[path] is None:
+            valid.append(path)
+        else:
+            problems.append((path, verdicts[path]))
+    return valid, problems
+
+def iter_valid(paths, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+    """Yield the members of C{paths} which pass L{validate_paths}, logging
+    the rest. Paths are checked in chunks so this works on streams too.
+
+    Extra keyword arguments are passed to L{validate_paths}.
+    """
+    mounts = kwargs.pop('mounts', None) or read_mounts()
+    hung = set()
+
+    def check(chunk):
+        """Validate one chunk and report the problems"""
+        valid, problems = validate_paths(chunk, mounts=mounts, hung=hung,
+                                         **kwargs)
+        for path, reason in problems:
+            log.warning("Skipping %s: %s", path, reason)
+        return valid
+
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) >= chunk_size:
+            for valid in check(chunk):
+                yield valid
+            chunk = []
+    for valid in check(chunk):
+        yield valid
@@ -0,0 +1,136 @@
+"""Directory traversal helpers"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import os, sys, threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Use scandir if available (stdlib in Python 3.5+, a backport before that)
+# since it gets file types from readdir() rather than stat()ing every entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None  # pylint: disable=invalid-name
+
+def _scan_dir(fldr, keep=None):
+    """List one directory, returning C{(subdirs, wanted_files)}.
+
+    Matches C{os.walk}'s defaults: unreadable directories are silently
+    skipped and symlinks to directories are not followed.
+    """
+    subdirs, files = [], []
+    try:
+        if scandir is None:
+            entries = [(x, os.path.join(fldr, x)) for x in os.listdir(fldr)]
+            for name, path in entries:
+                if os.path.isdir(path):
+                    if not os.path.islink(path):
+                        subdirs.append(path)
+                elif keep is None or keep(name):
+                    files.append(path)
+            return subdirs, files
+
+        entries = list(scandir(fldr))
+    except OSError:
+        return subdirs, files
+
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            if not entry.is_symlink():
+                subdirs.append(entry.path)
+        elif keep is None or keep(entry.name):
+            files.append(entry.path)
+    return subdirs, files
+
+def iter_files(root, keep=None):
+    """Yield the path of every file under C{root} whose name passes C{keep}.
+
+    @param keep: A callable which takes a bare filename and returns C{True}
+        if it's wanted. Paths are only built for names which pass.
+    """
+    stack = [root]
+    while stack:
+        subdirs, files = _scan_dir(stack.pop(), keep)
+        stack.extend(subdirs)
+        for path in files:
+            yield path
+
+def iter_files_parallel(roots, keep=None, jobs=4):
+    """Like L{iter_files} but walk all of C{roots} using C{jobs} threads.
+
+    Directories from every root share one work queue, so slow mounts don't
+    hold up fast ones. The order in which paths are yielded is arbitrary.
+
+    If C{keep} raises an exception in a worker, the walk is cancelled and
+    the exception is re-raised in the consumer.
+    """
+    pending, batches = queue.Queue(), queue.Queue(maxsize=jobs * 4)
+    cancelled, errors = threading.Event(), []
+
+    def worker():
+        """Scan directories until told to stop by a C{None}"""
+        while True:
+            fldr = pending.get()
+            if fldr is None:
+                return
+            try:
+                if not cancelled.is_set():
+                    subdirs, files = _scan_dir(fldr, keep)
+                    for path in subdirs:
+                        pending.put(path)
+                    if files:
+                        batches.put(files)
+            except Exception:  # pylint: disable=broad-except
+                errors.append(sys.exc_info())
+                cancelled.set()
+            finally:
+                pending.task_done()
+
+    def finisher():
+        """Signal the consumer and the workers once the walk is complete"""
+        pending.join()
+        for _ in range(jobs):
+            pending.put(None)
+        batches.put(None)
+
+    for root in roots:
+        pending.put(root)
+    threads = [threading.Thread(target=x)
+               for x in [worker] * jobs + [finisher]]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    batch = ()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                if errors:
+                    raise errors[0][0], errors[0][1], errors[0][2]
+                return
+            for path in batch:
+                yield path
+    finally:
+        # If the consumer stopped early, unblock the workers and let them
+        # drain the remaining queue without doing any more I/O.
+        cancelled.set()
+        while batch is not None:
+            batch = batches.get()
+        for thread in threads:
+            thread.join()
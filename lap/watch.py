@@ -0,0 +1,340 @@
+"""Persistent, inotify-maintained snapshots of a media library
+
+A L{LibrarySnapshot} remembers every directory under a root along with its
+mtime, files and subdirectories, so bringing a saved snapshot up to date
+only costs a C{stat} per directory plus a listing of those which changed.
+While the daemon is running, a L{Watcher} keeps its snapshots current from
+inotify events, so random selections never need to walk the tree at all.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import ctypes, ctypes.util, errno, hashlib, logging, marshal, os, select
+import struct, threading, time
+log = logging.getLogger(__name__)
+
+from .cache import get_cache_path
+from .walk import _scan_dir
+
+SNAPSHOT_VERSION = 1
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CLOSE_WRITE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (name follows)
+
+def get_snapshot_path(root):
+    """Return where the snapshot for C{root} is saved."""
+    return get_cache_path('snapshot-%s.marshal' %
+                          hashlib.sha1(root).hexdigest()[:16])
+
+class LibrarySnapshot(object):
+    """In-memory listing of every file under C{root}.
+
+    C{dirs} maps each directory to C{(mtime, file_names, subdir_names)}.
+    C{generation} goes up whenever the listing changes so anything derived
+    from it (eg. the daemon's L{WeightedPool}s) can tell when it's stale.
+    """
+    def __init__(self, root, dirs=None):
+        self.root = os.path.abspath(root)
+        self.dirs = dirs or {}
+        self.dirty = False
+        self.generation = 0
+
+    def _changed(self):
+        """Note that the listing has changed since it was last saved"""
+        self.dirty = True
+        self.generation += 1
+
+    @classmethod
+    def load(cls, root, path=None):
+        """Return the saved snapshot for C{root} or an empty one."""
+        root = os.path.abspath(root)
+        try:
+            with open(path or get_snapshot_path(root), 'rb') as fobj:
+                data = marshal.load(fobj)
+        except (IOError, EOFError, ValueError, TypeError):
+            return cls(root)
+
+        if data.get('version') != SNAPSHOT_VERSION or data['root'] != root:
+            return cls(root)
+        return cls(root, data['dirs'])
+
+    def save(self, path=None):
+        """Persist the snapshot if anything changed since the last save."""
+        if not self.dirty:
+            return
+        path = path or get_snapshot_path(self.root)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fobj:
+                marshal.dump({'version': SNAPSHOT_VERSION,
+                              'root': self.root, 'dirs': self.dirs}, fobj)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), err:
+            log.warning("Could not save snapshot of %s: %s", self.root, err)
+            return
+        self.dirty = False
+
+    def drop(self, path):
+        """Forget C{path} and everything under it."""
+        prefix = path.rstrip(os.sep) + os.sep
+        for dir_path in [x for x in self.dirs
+                         if x == path or x.startswith(prefix)]:
+            del self.dirs[dir_path]
+        self._changed()
+
+    def refresh(self, path=None, on_scan=None):
+        """Bring C{path} (default: the root) and everything under it up to
+        date, only re-listing directories whose mtime has changed.
+
+        @param on_scan: Called with each directory's path just before it's
+            listed, so a watch can be placed on it without a gap.
+        @returns: The number of directories which were re-listed.
+        """
+        rescanned, stack = 0, [path or self.root]
+        while stack:
+            dir_path = stack.pop()
+            old = self.dirs.get(dir_path)
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                if old is not None:
+                    self.drop(dir_path)
+                continue
+
+            if old is not None and old[0] == mtime:
+                stack.extend(os.path.join(dir_path, x) for x in old[2])
+                continue
+
+            if on_scan:
+                on_scan(dir_path)
+            subdirs, files = _scan_dir(dir_path)
+            subdir_names = [os.path.basename(x) for x in subdirs]
+            if old is not None:
+                for name in set(old[2]).difference(subdir_names):
+                    self.drop(os.path.join(dir_path, name))
+
+            self.dirs[dir_path] = (mtime,
+                                   [os.path.basename(x) for x in files],
+                                   subdir_names)
+            stack.extend(subdirs)
+            rescanned += 1
+
+        if rescanned:
+            self._changed()
+        return rescanned
+
+    def _set_member(self, dir_path, field, name, present=True):
+        """Add or remove C{name} from C{dir_path}'s list of files
+        (C{field=1}) or subdirectories (C{field=2})"""
+        entry = self.dirs.get(dir_path)
+        if entry is None:
+            return
+        names = entry[field]
+        if present and name not in names:
+            names.append(name)
+        elif not present and name in names:
+            names.remove(name)
+        self._changed()
+
+    def apply_event(self, dir_path, mask, name, on_scan=None):
+        """Update the snapshot for an inotify event on C{dir_path}."""
+        path = os.path.join(dir_path, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._set_member(dir_path, 2, name)
+                self.refresh(path, on_scan)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._set_member(dir_path, 2, name, present=False)
+                self.drop(path)
+        elif mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._set_member(dir_path, 1, name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._set_member(dir_path, 1, name, present=False)
+
+    def iter_files(self, keep=None):
+        """Yield the path of every file whose name passes C{keep}."""
+        for dir_path, (_, files, _) in self.dirs.items():
+            for name in files:
+                if keep is None or keep(name):
+                    yield os.path.join(dir_path, name)
+
+def get_snapshot(root):
+    """Load the saved snapshot for C{root}, bring it up to date and save it
+    again. For use without a L{Watcher}."""
+    snapshot = LibrarySnapshot.load(root)
+    snapshot.refresh()
+    snapshot.save()
+    return snapshot
+
+class Inotify(object):
+    """Minimal C{ctypes} binding for Linux's inotify API"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch C{path} and return its watch descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching the given watch descriptor, ignoring errors."""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """Wait up to C{timeout} seconds and return a list of
+        C{(wd, mask, name)} tuples."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events, pos = [], 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+class Watcher(object):
+    """Keeps a set of L{LibrarySnapshot}s current from inotify events in a
+    background thread.
+
+    If the kernel's event queue overflows or a watch can't be added (eg.
+    C{fs.inotify.max_user_watches} was reached), affected snapshots fall
+    back to L{LibrarySnapshot.refresh}, which only re-lists directories
+    whose mtime changed.
+    """
+    save_interval = 60
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.wds = {}
+        self.incomplete = set()
+        self._thread = None
+
+    def _add_watch(self, snapshot, path):
+        """Watch C{path}, noting if we couldn't"""
+        try:
+            self.wds[self.inotify.add_watch(path)] = (snapshot, path)
+        except OSError, err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                # It's gone. Its parent's events or mtime will say so.
+                log.debug("Not watching vanished directory %s", path)
+                return
+            if snapshot.root not in self.incomplete:
+                log.warning("Can't watch everything under %s: %s",
+                            snapshot.root, err)
+            self.incomplete.add(snapshot.root)
+
+    def get(self, root):
+        """Return an up-to-date snapshot of C{root}, starting to watch it
+        if this is the first request for it."""
+        root = os.path.abspath(root)
+        with self.lock:
+            snapshot = self.snapshots.get(root)
+            if snapshot is None:
+                snapshot = LibrarySnapshot.load(root)
+                on_scan = lambda path: self._add_watch(snapshot, path)
+                for path in list(snapshot.dirs):
+                    if os.path.isdir(path):
+                        on_scan(path)
+                    elif path in snapshot.dirs:  # Not already dropped
+                        snapshot.drop(path)
+                snapshot.refresh(on_scan=on_scan)
+                snapshot.save()
+                self.snapshots[root] = snapshot
+            elif root in self.incomplete:
+                snapshot.refresh(on_scan=lambda path:
+                                 self._add_watch(snapshot, path))
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+        return snapshot
+
+    def _handle(self, wd, mask, name):
+        """Apply one event to the snapshot it belongs to"""
+        if mask & IN_Q_OVERFLOW:
+            log.info("inotify queue overflowed. Rescanning changed "
+                     "directories.")
+            for snapshot in self.snapshots.values():
+                snapshot.refresh(on_scan=lambda path, snapshot=snapshot:
+                                 self._add_watch(snapshot, path))
+            return
+
+        target = self.wds.get(wd)
+        if target is None:
+            return
+        snapshot, dir_path = target
+
+        if mask & IN_IGNORED:
+            del self.wds[wd]
+        elif name:
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self._unwatch(os.path.join(dir_path, name))
+            snapshot.apply_event(dir_path, mask, name,
+                on_scan=lambda path: self._add_watch(snapshot, path))
+
+    def _unwatch(self, path):
+        """Remove the watches on C{path} and everything under it, which
+        would otherwise keep reporting events under its old name."""
+        prefix = path.rstrip(os.sep) + os.sep
+        for wd, (_, dir_path) in self.wds.items():
+            if dir_path == path or dir_path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.wds[wd]
+
+    def run(self):
+        """Process events until the process exits"""
+        next_save = time.time() + self.save_interval
+        while True:
+            events = self.inotify.read_events(timeout=1)
+            with self.lock:
+                for wd, mask, name in events:
+                    self._handle(wd, mask, name)
+
+                if time.time() > next_save:
+                    next_save = time.time() + self.save_interval
+                    self.save()
+
+    def save(self):
+        """Persist every snapshot which has changed."""
+        for snapshot in self.snapshots.values():
+            snapshot.save()
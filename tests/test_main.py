@@ -0,0 +1,59 @@
+"""Tests for how C{lap.__main__} hands its results to the backends
+
+Run with C{python -m unittest discover tests}.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import os, shutil, socket, sys, tempfile, threading, unittest
+
+from lap import __main__ as lap_main, daemon
+
+try:
+    import dbus  # pylint: disable=unused-import
+except ImportError:
+    dbus = None  # pylint: disable=invalid-name
+
+@unittest.skipIf(dbus is None, "dbus-python is required")
+class TestDaemonAdd(unittest.TestCase):
+    """Test adding to a player through a L{daemon.LapDaemon}"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'song.mp3')
+        open(self.path, 'w').close()
+
+        self.added = []
+        self.server = daemon.LapDaemon(os.path.join(self.tmpdir, 'sock'))
+        # pylint: disable=protected-access
+        self.server._get_adder = lambda players: (
+            lambda paths, play: self.added.extend(paths))
+
+        client_sock, server_sock = socket.socketpair()
+        self.thread = threading.Thread(target=self.server.handle,
+                                       args=(server_sock,))
+        self.thread.start()
+        self.client = daemon.DaemonClient(client_sock)
+
+        self.old_connect, self.old_argv = daemon.connect, sys.argv
+        daemon.connect = lambda path=None: self.client
+
+    def tearDown(self):
+        daemon.connect, sys.argv = self.old_connect, self.old_argv
+        self.client.sock.close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_exit_status(self):
+        """A successful add through the daemon exits with status 0"""
+        sys.argv = ['ap', self.path]
+        with self.assertRaises(SystemExit) as ctx:
+            sys.exit(lap_main.main())
+        self.assertIn(ctx.exception.code, (None, 0))
+        self.assertEqual(self.added, [self.path])
+
+if __name__ == '__main__':
+    unittest.main()
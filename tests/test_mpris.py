@@ -0,0 +1,233 @@
+"""Tests for the pipelined MPRIS backend, run against a stand-in bus
+
+Run with C{python -m unittest discover tests}. Requires dbus-python, but
+not a session bus or a running player.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import os, shutil, tempfile, unittest
+
+try:
+    from lap.output.mpris import MPRISAdder, PlayerCache, PlayerGoneError
+    from dbus.exceptions import DBusException
+except ImportError:
+    MPRISAdder = None
+
+TRACKLIST_XML = """<node><interface name="org.freedesktop.MediaPlayer">
+<method name="AddTrack"/><method name="GetLength"/></interface></node>"""
+
+class FakeMethod(object):
+    """A D-Bus method which replies through its L{FakeBus}'s queue"""
+    def __init__(self, bus, name, impl):
+        self.bus, self.name, self.impl = bus, name, impl
+
+    def __call__(self, *args, **kwargs):
+        reply_handler = kwargs.pop('reply_handler', None)
+        error_handler = kwargs.pop('error_handler', None)
+        ignore_reply = kwargs.pop('ignore_reply', False)
+        self.bus.calls.append((self.name,) + args)
+
+        if reply_handler:
+            self.bus.replies.append((self.impl, args, reply_handler,
+                                     error_handler))
+        elif ignore_reply:
+            self.bus.unanswered += 1
+            try:
+                self.impl(*args)
+            except DBusException:
+                pass
+        else:
+            return self.impl(*args)
+
+class FakeObject(object):
+    """Minimal stand-in for C{dbus.proxies.ProxyObject}"""
+    def __init__(self, bus, methods):
+        self.bus, self.methods = bus, methods
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        """Called by C{dbus.Interface} for each method lookup"""
+        return FakeMethod(self.bus, member, self.methods[member])
+
+class FakeLoop(object):
+    """Main loop which delivers the L{FakeBus}'s queued replies in order"""
+    def __init__(self, bus):
+        self.bus, self.running = bus, False
+
+    def run(self):
+        """Deliver replies until L{quit} is called"""
+        self.running = True
+        while self.running and self.bus.replies:
+            impl, args, reply_handler, error_handler = \
+                self.bus.replies.pop(0)
+            try:
+                result = impl(*args)
+            except DBusException, err:
+                error_handler(err)
+            else:
+                reply_handler(result)
+        assert not self.running, "Loop would have blocked forever"
+
+    def quit(self):
+        """Stop L{run}"""
+        self.running = False
+
+class FakeBus(object):
+    """Session bus with an Audacious-like player and, optionally, others
+
+    @param owners: Maps the players' well-known names to unique names.
+    """
+    def __init__(self, fail_url=None, owners=None):
+        self.calls, self.replies, self.unanswered = [], [], 0
+        self.requested = []
+        self.playlist, self.queue, self.fail_url = [], [], fail_url
+        self.owners = owners or {'org.mpris.audacious': ':1.42'}
+        self.objects = {
+            ('org.freedesktop.DBus', '/'): {
+                'ListNames': lambda: list(self.owners),
+                'GetNameOwner': self._get_name_owner,
+                'GetId': lambda: 'f00dfeed',
+            },
+            ('org.mpris.audacious', '/org/atheme/audacious'): {
+                'AddList': lambda urls: [self._add_track(x, False)
+                                         for x in urls],
+                'PlayqueueAdd': self.queue.append,
+            },
+        }
+
+        self.tracklist = {
+            'Introspect': lambda: TRACKLIST_XML,
+            'AddTrack': self._add_track,
+            'GetLength': lambda: len(self.playlist),
+        }
+
+    def _get_name_owner(self, name):
+        """Implement GetNameOwner"""
+        if name not in self.owners:
+            raise DBusException("Name has no owner")
+        return self.owners[name]
+
+    def _add_track(self, url, play):
+        """Implement AddTrack"""
+        if url == self.fail_url:
+            raise DBusException("Can't open %s" % url)
+        self.playlist.append(url)
+
+    def get_object(self, name, path, introspect=True):
+        """Return a proxy for one of the objects above"""
+        self.requested.append((name, path))
+        if path == '/TrackList' and name in self.owners:
+            return FakeObject(self, self.tracklist)
+        return FakeObject(self, self.objects[(name, path)])
+
+@unittest.skipIf(MPRISAdder is None, "dbus-python is required")
+class TestPipelinedAdd(unittest.TestCase):
+    """Test L{MPRISAdder.add_tracks} with and without a main loop"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PlayerCache(os.path.join(self.tmpdir, 'players.json'))
+        self.old_address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = 'unix:path=/nonexistent'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if self.old_address is None:
+            del os.environ['DBUS_SESSION_BUS_ADDRESS']
+        else:
+            os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.old_address
+
+    def _adder(self, bus, mainloop=True):
+        """Build an adder for C{bus}, optionally with a L{FakeLoop}"""
+        return MPRISAdder(bus=bus, cache=self.cache,
+                          mainloop=mainloop and (lambda: FakeLoop(bus)))
+
+    def test_mainloop(self):
+        """Replies are collected asynchronously and in order"""
+        bus = FakeBus()
+        self._adder(bus).add_tracks(['/a.mp3', '/b.mp3', '/c.mp3'], True)
+
+        self.assertEqual(bus.playlist, ['file:///a.mp3', 'file:///b.mp3',
+                                        'file:///c.mp3'])
+        self.assertEqual(bus.queue, [1, 2])
+        self.assertEqual(bus.unanswered, 0)
+        self.assertEqual(bus.replies, [])
+        # One GetLength, then nothing but pipelined calls
+        self.assertEqual([x[0] for x in bus.calls[-5:]],
+            ['GetLength', 'AddTrack', 'AddList', 'PlayqueueAdd',
+             'PlayqueueAdd'])
+
+    def test_mainloop_errors(self):
+        """Error replies are reported rather than stopping the pipeline"""
+        bus = FakeBus(fail_url='file:///a.mp3')
+        self._adder(bus).add_tracks(['/a.mp3', '/b.mp3'], True)
+        self.assertEqual(bus.playlist, ['file:///b.mp3'])
+        self.assertEqual(bus.replies, [])
+
+    def test_no_mainloop(self):
+        """Without a loop, calls are fire-and-forget with a barrier"""
+        bus = FakeBus()
+        self._adder(bus, mainloop=False).add_tracks(['/a.mp3', '/b.mp3'])
+
+        self.assertEqual(bus.playlist, ['file:///a.mp3', 'file:///b.mp3'])
+        self.assertEqual(bus.queue, [0, 1])
+        self.assertEqual(bus.unanswered, 3)  # AddList + two PlayqueueAdd
+        self.assertEqual(bus.calls[-1], ('GetLength',))
+
+    def test_player_gone(self):
+        """An unreachable player is reported before anything is sent"""
+        def gone():
+            """Fail as a call to a player which has exited would"""
+            raise DBusException("The name :1.42 was not provided")
+
+        bus = FakeBus()
+        adder = self._adder(bus)
+        bus.tracklist['GetLength'] = gone
+        self.assertRaises(PlayerGoneError, adder.add_tracks, ['/a.mp3'])
+        self.assertEqual(bus.playlist, [])
+        self.assertEqual(bus.replies, [])
+
+@unittest.skipIf(MPRISAdder is None, "dbus-python is required")
+class TestPlayerCache(unittest.TestCase):
+    """Test how L{MPRISAdder} reuses its L{PlayerCache}"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PlayerCache(os.path.join(self.tmpdir, 'players.json'))
+        self.old_address = os.environ.pop('DBUS_SESSION_BUS_ADDRESS', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if self.old_address is not None:
+            os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.old_address
+
+    def _player(self, bus, preferred):
+        """Return the name of the player an adder connects to"""
+        MPRISAdder(bus=bus, preferred=preferred, cache=self.cache)
+        return [name for name, path in bus.requested
+                if path == '/TrackList'][-1]
+
+    def test_preferred_player_started(self):
+        """A newly-started preferred player beats the cached one"""
+        bus = FakeBus(owners={'org.mpris.vlc': ':1.7'})
+        self.assertEqual(self._player(bus, ['audacious']), 'org.mpris.vlc')
+        self.assertIn('GetId', [x[0] for x in bus.calls])
+
+        bus.owners['org.mpris.audacious'] = ':1.9'
+        bus.calls = []
+        self.assertEqual(self._player(bus, ['audacious']),
+                         'org.mpris.audacious')
+
+    def test_cached_player_reused(self):
+        """Without changes, the cache saves rediscovery"""
+        bus = FakeBus(owners={'org.mpris.vlc': ':1.7'})
+        self._player(bus, [])
+        bus.calls = []
+        self.assertEqual(self._player(bus, []), 'org.mpris.vlc')
+        self.assertNotIn('ListNames', [x[0] for x in bus.calls])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Startup-time regression check for each of lap's personalities
+
+Runs every personality in a fresh interpreter on a code path which does no
+real work (printing an empty selection) and fails if it takes longer than
+the budget or pulls in modules which only the choosers or the MPRIS backend
+should need.
+
+Since Python 2 has no C{-X importtime}, the child process times its own
+imports by wrapping C{__import__}. Use C{-v} to see the slowest ones.
+"""
+
+from __future__ import print_function, absolute_import
+
+__author__ = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2 or later"
+
+import json, os, shutil, subprocess, sys, tempfile
+
+# Seconds from interpreter start to the end of main() for each personality
+DEFAULT_BUDGET = 0.15
+
+# Modules which must not be imported when nothing is chosen or played
+FORBIDDEN = ['dbus', 'gi', 'gobject', 'readline', 'urwid',
+             'xml.etree.cElementTree']
+
+# argv for each personality, formatted with the path to an empty directory
+PERSONALITIES = {
+    'ap': ['-p', '{tmp}'],
+    'aq': ['-p', '{tmp}'],
+    'lap': ['-p', '-l', '--index', 'nothing'],
+    'laq': ['-p', '-l', '--index', 'nothing'],
+    'rap': ['-p', '{tmp}'],
+    'raq': ['-p', '{tmp}'],
+}
+
+CHILD = r"""
+import json, os, sys, time
+start = time.time()
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+timings, real_import = {}, builtins.__import__
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    before = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        timings.setdefault(name, time.time() - before)
+builtins.__import__ = timed_import
+
+sys.argv = json.loads(sys.argv[1])
+from lap.__main__ import main
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+try:
+    main()
+finally:
+    sys.stdout = stdout
+
+json.dump({'elapsed': time.time() - start,
+           'modules': sorted(sys.modules),
+           'timings': timings}, sys.stdout)
+"""
+
+def check(name, argv, budget, verbose=False):
+    """Run one personality and return a list of problems with it."""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD, json.dumps([name] + argv)], env=env)
+    report = json.loads(output)
+
+    problems = []
+    if report['elapsed'] > budget:
+        problems.append("took %.3fs (budget: %.3fs)" % (
+            report['elapsed'], budget))
+    for mod in FORBIDDEN:
+        if mod in report['modules']:
+            problems.append("imported %s" % mod)
+
+    print("%-4s %.3fs %s" % (name, report['elapsed'],
+                             'FAIL' if problems else 'ok'))
+    if verbose:
+        slowest = sorted(report['timings'].items(), key=lambda x: -x[1])
+        for mod, secs in slowest[:10]:
+            print("       %.4fs %s" % (secs, mod))
+    return problems
+
+def main():
+    """The main entry point, compatible with setuptools entry points."""
+    from optparse import OptionParser
+    opars = OptionParser(description=__doc__.split('\n\n')[0])
+    opars.add_option('-b', '--budget', type=float, default=DEFAULT_BUDGET,
+                     help="Maximum startup time in seconds "
+                          "(default: %default)")
+    opars.add_option('-v', '--verbose', action="store_true", default=False,
+                     help="List the slowest imports for each personality")
+    opts, _ = opars.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='lap-startup-')
+    os.environ['XDG_CACHE_HOME'] = tmp
+    failed = False
+    try:
+        for name in sorted(PERSONALITIES):
+            argv = [x.format(tmp=tmp) for x in PERSONALITIES[name]]
+            for problem in check(name, argv, opts.budget, opts.verbose):
+                print("     %s" % problem)
+                failed = True
+    finally:
+        shutil.rmtree(tmp)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sw=4 sts=4 :